@@ -1,11 +1,11 @@
 import d3 from "d3";
-import d3Promise from "d3.promise";
 import nv from "nvd3";
+import loadCompact, {sum} from "./compact.js";
 
 
 export default class {
     constructor(parentId) {
-        this.dataset = this.loadData("data/country_tag.csv");
+        this.dataset = this.loadData("data/country_tag.min.json");
         this.container = d3.select("#" + parentId);
         this.selectedCountry = "XXX";
         this.draw();
@@ -108,19 +108,29 @@ export default class {
     }
 
     async loadData(filename) {
-        var data = await d3Promise.csv(filename);
+        var {data, tags, countries} = await loadCompact(filename);
         var dataset = {};
 
-        data.forEach(item => {
-            if(typeof dataset[item.country] === "undefined") {
-                dataset[item.country] = {key: item.country, values: []};
+        var addCountry = (country, counts) => {
+            var total = sum(counts);
+            if(total == 0) {
+                return;
             }
-            dataset[item.country].values.push({
-                tag: item.tag,
-                count: +item.count,
-                freq: +item.freq
+
+            dataset[country] = {key: country, values: []};
+            counts.forEach((count, i) => {
+                if(count > 0) {
+                    dataset[country].values.push({
+                        tag: tags[i],
+                        count: count,
+                        freq: count / total
+                    });
+                }
             });
-        });
+        };
+
+        countries.forEach((country, i) => addCountry(country, data.count[i]));
+        addCountry("XXX", data.worldwide);
 
         return dataset;
     }
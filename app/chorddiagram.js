@@ -1,17 +1,27 @@
 import d3 from "d3";
-import d3Promise from "d3.promise";
+import loadCompact, {sliceMatrix} from "./compact.js";
 
 
 export default class {
     constructor(parentId) {
         this.container = d3.select("#" + parentId);
-        this.dataset = this.loadData("data/tag_matrix.json");
+        this.dataset = this.loadData("data/tag_matrix.min.json");
+        this.selectedTags = [];
+        this.selectedCountry = "XXX";
         this.nodata(); // TODO remove this
 
+        // The matrices by country are optional
+        this.countryDatasets = loadCompact(
+            "data/tag_matrix_by_country.min.json").catch(() => null);
+
         window.addEventListener(
             "tagSelectionChange",
             this.onTagSelectionChange.bind(this),
             false);
+        window.addEventListener(
+            "countryClick",
+            this.onCountryClick.bind(this),
+            false);
     }
 
     draw(dataset) {
@@ -96,8 +106,18 @@ export default class {
         text[0][0].innerHTML = "No Data Available.";
     }
 
-    async onTagSelectionChange(event) {
-        var selectedTags = event.detail;
+    onTagSelectionChange(event) {
+        this.selectedTags = event.detail;
+        this.update();
+    }
+
+    onCountryClick(event) {
+        this.selectedCountry = event.detail;
+        this.update();
+    }
+
+    async update() {
+        var selectedTags = this.selectedTags;
 
         if(selectedTags.length > 1) {
             var data = await this.filterData(selectedTags);
@@ -110,7 +130,7 @@ export default class {
     }
 
     async filterData(tags) {
-        var dataset = await this.dataset;
+        var dataset = await this.countryDataset(this.selectedCountry);
 
         var tagByIndex = Object.assign({}, tags);
         var indexByTag = tags.reduce((a, b) =>
@@ -133,7 +153,34 @@ export default class {
         };
     }
 
+    // Worldwide, or when there is no matrix for the country, the matrix of
+    // all posts is used
+    async countryDataset(country) {
+        var sliced = await this.countryDatasets;
+        if(country != "XXX" && sliced) {
+            var matrix = sliceMatrix(sliced.data, country, sliced.tags.length);
+            if(matrix) {
+                return indexByTags(matrix, sliced.tags);
+            }
+        }
+        return this.dataset;
+    }
+
     loadData(filename) {
-        return d3Promise.json(filename);
+        return loadCompact(filename).then(({data, tags}) =>
+            indexByTags(data, tags));
     }
 }
+
+
+// Index a matrix of counts by tag name
+function indexByTags(data, tags) {
+    var dataset = {};
+    tags.forEach((i, m) => {
+        dataset[i] = {};
+        tags.forEach((j, n) => {
+            dataset[i][j] = data[m][n];
+        });
+    });
+    return dataset;
+}
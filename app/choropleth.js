@@ -1,11 +1,11 @@
 import d3 from "d3";
-import d3Promise from "d3.promise";
 import Datamap from "datamaps";
+import loadCompact from "./compact.js";
 
 
 export default class {
     constructor(elementId) {
-        this.dataset = this.loadData("data/country_tag.csv");
+        this.dataset = this.loadData("data/country_tag.min.json");
 
         this.map = new Datamap({
             element: document.getElementById(elementId),
@@ -64,16 +64,23 @@ export default class {
     }
 
     loadData(filename) {
-        // Load data from CSV
-        return d3Promise.csv(filename).then(data => {
+        return loadCompact(filename).then(({data, tags, countries}) => {
             // Prepare the dataset
             var dataset = {};
-            data.forEach(item => {
-                if(typeof dataset[item.tag] === "undefined") {
-                    dataset[item.tag] = {};
-                }
-                dataset[item.tag][item.country] = +item.count;
-            });
+            var addCountry = (country, counts) => {
+                counts.forEach((count, i) => {
+                    if(count > 0) {
+                        if(typeof dataset[tags[i]] === "undefined") {
+                            dataset[tags[i]] = {};
+                        }
+                        dataset[tags[i]][country] = count;
+                    }
+                });
+            };
+
+            countries.forEach((country, i) =>
+                addCountry(country, data.count[i]));
+            addCountry("XXX", data.worldwide);
 
             for(var tag in dataset) {
                 // Create color palette
@@ -0,0 +1,46 @@
+import d3Promise from "d3.promise";
+
+
+// The compact data sets identify tags and countries by their position in
+// tags.json and countries.json, with "Other" after the last tag.
+export default async function loadCompact(filename) {
+    var [data, tags, countries] = await Promise.all([
+        d3Promise.json(filename),
+        d3Promise.json("data/tags.json"),
+        d3Promise.json("data/countries.json")
+    ]);
+
+    return {
+        data: data,
+        tags: tags.concat(["Other"]),
+        countries: Object.keys(countries)
+    };
+}
+
+export function sum(values) {
+    return values.reduce((a, b) => a + b, 0);
+}
+
+// The co-occurrence matrices by year or country keep the counts of each
+// tag, and only the top pairs of tags as flat [tag1, tag2, count] triples.
+// Pairs that were left out are counted as zero.
+export function sliceMatrix(sliced, slice, size) {
+    var position = sliced.slices.indexOf(slice);
+    if(position < 0) {
+        return null;
+    }
+
+    var {totals, edges} = sliced.matrices[position];
+    var matrix = totals.map((total, i) => {
+        var row = new Array(size).fill(0);
+        row[i] = total;
+        return row;
+    });
+
+    for(var k = 0; k < edges.length; k += 3) {
+        matrix[edges[k]][edges[k + 1]] = edges[k + 2];
+        matrix[edges[k + 1]][edges[k]] = edges[k + 2];
+    }
+
+    return matrix;
+}
@@ -1,11 +1,11 @@
 import d3 from "d3";
-import d3Promise from "d3.promise";
 import nv from "nvd3";
+import loadCompact, {sum} from "./compact.js";
 
 
 export default class {
     constructor(parentId) {
-        this.dataset = this.loadData("data/tag_year.csv");
+        this.dataset = this.loadData("data/tag_year.min.json");
         this.container = parentId;
         this.draw();
         window.addEventListener(
@@ -87,20 +87,21 @@ export default class {
     }
 
     async loadData(filename) {
-        var data = await d3Promise.csv(filename);
-        var dataset = {};
-
-        data.forEach(item => {
-            if(typeof dataset[item.tag] === "undefined") {
-                dataset[item.tag] = {key: item.tag, values: []};
-            }
-            dataset[item.tag].values.push({
-                x: +item.year,
-                y: +item.freq,
-                count: +item.count
-            });
-        });
-
-        return Object.values(dataset);
+        var {data, tags} = await loadCompact(filename);
+
+        // Number of posts of each year, over all tags
+        var totals = data.years.map((year, j) =>
+            sum(data.count.map(counts => counts[j])));
+
+        return tags.map((tag, i) => ({
+            key: tag,
+            values: data.years
+                .map((year, j) => ({
+                    x: year,
+                    y: data.count[i][j] / totals[j],
+                    count: data.count[i][j]
+                }))
+                .filter(item => item.count > 0)
+        }));
     }
 }
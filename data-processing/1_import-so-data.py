@@ -1,35 +1,336 @@
 #!/usr/bin/env python3
 
+from collections import deque
 import configparser
+from contextlib import contextmanager
+import html
+from itertools import islice
+from multiprocessing import Pool
+import os
+import shutil
 import sqlite3
+import subprocess
+import sys
+import time
 from xml.etree import ElementTree
 
+import instrumentation
 
-def main():
-    config = configparser.ConfigParser()
-    config.read("stacktrends.ini")
+ROW_START = b"<row"
+
+# Decompressors for the compressed dumps, in order of preference. Each one
+# runs in a separate process, so that decompression overlaps with parsing
+# (and lbzip2, pbzip2 and pigz use several cores). Python's own modules
+# are the last resort.
+PYTHON_DECOMPRESS = ("import %s, shutil, sys; shutil.copyfileobj("
+                     "%s.open(sys.argv[1]), sys.stdout.buffer, 2**20)")
+DECOMPRESSORS = {
+    ".7z": [["7z", "e", "-so"], ["7za", "e", "-so"], ["7zz", "e", "-so"]],
+    ".bz2": [["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"],
+             [sys.executable, "-c", PYTHON_DECOMPRESS % ("bz2", "bz2")]],
+    ".gz": [["pigz", "-dc"], ["gzip", "-dc"],
+            [sys.executable, "-c", PYTHON_DECOMPRESS % ("gzip", "gzip")]],
+}
 
-    con = sqlite3.connect(config["Database"]["filename"])
 
-    import_table(con, "data/raw/Users.xml",
-                 ("Id", "Location"),
+USERS_COLUMNS = (("Id", "Location"),
                  ("INTEGER PRIMARY KEY", "TEXT"))
-    import_table(con, "data/raw/Posts.xml",
-                 ("Id", "PostTypeId", "ParentId", "CreationDate",
+POSTS_COLUMNS = (("Id", "PostTypeId", "ParentId", "CreationDate",
                   "OwnerUserId", "Tags"),
                  ("INTEGER PRIMARY KEY", "INTEGER", "INTEGER", "TEXT",
                   "INTEGER", "TEXT"))
 
-    # Clean up users.Location
-    con.execute("UPDATE users SET Location = TRIM(Location)")
-    con.execute("UPDATE users SET Location = NULL WHERE Location = ''")
-    con.commit()
 
-    con.execute("VACUUM")
+def main():
+    config = configparser.ConfigParser()
+    config.read("stacktrends.ini")
+    import_config = config["Import"]
+    incremental = import_config.getboolean("incremental", False)
+    instrumentation.start("1_import-so-data", config)
+
+    con = sqlite3.connect(config["Database"]["filename"])
+    set_import_pragmas(con, import_config, incremental)
+    options = {
+        "batch_size": int(import_config.get("batch_size", 10000)),
+        "workers": int(import_config.get("workers", 1)),
+        "shard_size": int(import_config.get("shard_size", 64)) * 2**20,
+    }
+    users_parser = import_config.get("users_parser", "etree")
+    posts_parser = import_config.get("posts_parser", "etree")
+
+    create_state_tables(con, reset=not incremental)
+
+    # The dumps can be read from the compressed archives as well
+    users_file = find_source("data/raw", "Users")
+    posts_file = find_source("data/raw", "Posts")
+
+    if incremental:
+        with instrumentation.stage("users") as stage:
+            stage.rows = import_users_incremental(
+                con, users_file, dict(options, parser=users_parser))
+        with instrumentation.stage("posts") as stage:
+            stage.rows = import_posts_incremental(
+                con, posts_file, dict(options, parser=posts_parser))
+    else:
+        with instrumentation.stage("users") as stage:
+            stage.rows = import_table(con, users_file, *USERS_COLUMNS,
+                                      parser=users_parser, **options)
+        with instrumentation.stage("posts") as stage:
+            stage.rows = import_table(
+                con, posts_file, *POSTS_COLUMNS,
+                indexes=("ParentId", "OwnerUserId", "CreationDate"),
+                parser=posts_parser, **options)
+        with instrumentation.stage("post_tags") as stage:
+            stage.rows = import_post_tags(con,
+                                          batch_size=options["batch_size"])
+
+        # Any year may have changed since the data sets were last created,
+        # so none of the cached partial counts can be reused
+        with con:
+            con.execute("INSERT OR IGNORE INTO dirty_years "
+                        "SELECT DISTINCT SUBSTR(CreationDate, 1, 4) "
+                        "FROM posts")
+
+        with instrumentation.stage("locations"):
+            clean_locations(con, "users")
+            con.execute("CREATE INDEX IF NOT EXISTS users_Location "
+                        "ON users (Location)")
+            con.commit()
+
+    # Optionally, also store the posts in a columnar format for the
+    # data sets step
+    intermediate_config = config["Intermediate"]
+    if intermediate_config.get("format", "sqlite") == "parquet":
+        with instrumentation.stage("parquet") as stage:
+            stage.rows = export_posts_parquet(
+                con, intermediate_config["directory"], incremental,
+                rows_per_file=int(intermediate_config.get(
+                    "rows_per_file", 1000000)))
+
+    with instrumentation.stage("vacuum"):
+        update_import_state(con)
+        con.execute("VACUUM")
     con.close()
 
+    instrumentation.finish()
+
+
+def set_import_pragmas(con, config, incremental=False):
+    pragmas = ["cache_size"]
+
+    # A full import can always be restarted from the XML files, so we
+    # trade durability for speed while it runs. An incremental import
+    # modifies existing data, so it keeps the default settings.
+    if not incremental:
+        pragmas += ["journal_mode", "synchronous"]
+
+    for pragma in pragmas:
+        value = config.get(pragma)
+        if value:
+            con.execute("PRAGMA %s = %s" % (pragma, value))
+
+
+def clean_locations(con, table):
+    con.execute("UPDATE " + table + " SET Location = TRIM(Location)")
+    con.execute("UPDATE " + table + " SET Location = NULL "
+                "WHERE Location = ''")
+
+
+def create_state_tables(con, reset=False):
+    with con:
+        # import_state records how far each table has been imported, and
+        # the dirty_* tables record which users and years have changed
+        # since the data sets were last created
+        if reset:
+            for table in ("import_state", "dirty_users", "dirty_years"):
+                con.execute("DROP TABLE IF EXISTS " + table)
+
+        con.execute("CREATE TABLE IF NOT EXISTS import_state "
+                    "(tbl TEXT PRIMARY KEY, max_id INTEGER, "
+                    "max_creation_date TEXT)")
+        con.execute("CREATE TABLE IF NOT EXISTS dirty_users "
+                    "(Id INTEGER PRIMARY KEY)")
+        con.execute("CREATE TABLE IF NOT EXISTS dirty_years "
+                    "(year TEXT PRIMARY KEY)")
+
+
+def update_import_state(con):
+    with con:
+        con.execute("INSERT OR REPLACE INTO import_state "
+                    "SELECT 'users', MAX(Id), NULL FROM users")
+        con.execute("INSERT OR REPLACE INTO import_state "
+                    "SELECT 'posts', MAX(Id), MAX(CreationDate) FROM posts")
+
+
+def get_max_id(con, table):
+    row = con.execute("SELECT max_id FROM import_state WHERE tbl = ?",
+                      (table,)).fetchone()
+    if row is None or row[0] is None:
+        raise RuntimeError("No previous import of %s found; "
+                           "run a full import first" % table)
+    return row[0]
+
+
+def import_users_incremental(con, filename, options):
+    # Every user in the dump is compared against the existing table, so
+    # that users whose location changed are picked up too
+    row_count = import_table(con, filename, *USERS_COLUMNS,
+                             table="users_staging", **options)
+    clean_locations(con, "users_staging")
+
+    with con:
+        # Only the users changed by this dump are upserted and dirty their
+        # years; dirty_users may still hold those of earlier dumps
+        con.execute("CREATE TEMP TABLE changed_users "
+                    "(Id INTEGER PRIMARY KEY)")
+        con.execute("INSERT INTO changed_users "
+                    "SELECT s.Id FROM users_staging s "
+                    "LEFT JOIN users u ON u.Id = s.Id "
+                    "WHERE u.Id IS NULL OR u.Location IS NOT s.Location")
+        con.execute("INSERT OR REPLACE INTO users "
+                    "SELECT s.* FROM users_staging s "
+                    "JOIN changed_users c ON c.Id = s.Id")
+        con.execute("INSERT OR IGNORE INTO dirty_users "
+                    "SELECT Id FROM changed_users")
+        con.execute("DROP TABLE users_staging")
+
+        # The posts of users who moved count towards a different country
+        con.execute("INSERT OR IGNORE INTO dirty_years "
+                    "SELECT DISTINCT SUBSTR(CreationDate, 1, 4) FROM posts "
+                    "WHERE OwnerUserId IN (SELECT Id FROM changed_users)")
+        con.execute("DROP TABLE changed_users")
+
+    return row_count
+
+
+def import_posts_incremental(con, filename, options):
+    max_id = get_max_id(con, "posts")
+
+    row_count = import_table(con, filename, *POSTS_COLUMNS, replace=False,
+                             min_id=max_id, **options)
+    import_post_tags(con, min_id=max_id, batch_size=options["batch_size"])
+
+    with con:
+        con.execute("INSERT OR IGNORE INTO dirty_years "
+                    "SELECT DISTINCT SUBSTR(CreationDate, 1, 4) FROM posts "
+                    "WHERE Id > ?", (max_id,))
+
+    return row_count
+
+
+def import_post_tags(con, min_id=None, batch_size=10000):
+    """Create a normalized post_tags table from the Tags of the posts.
+
+    In the data dump, only questions have tags, so answers are given
+    the tags of their parent question. Tag names are stored once in
+    the tags table. If min_id is given, only posts with a greater Id
+    are added to the existing tables.
+    """
+    query = ("SELECT p.Id, COALESCE(q.Tags, p.Tags) FROM posts p "
+             "LEFT JOIN posts q ON p.PostTypeId = 2 AND q.Id = p.ParentId "
+             "WHERE p.Id > ?")
+
+    row_count = 0
+    start_time = time.time()
+
+    with con:
+        if min_id is None:
+            con.execute("DROP TABLE IF EXISTS tags")
+            con.execute("DROP TABLE IF EXISTS post_tags")
+        con.execute("CREATE TABLE IF NOT EXISTS tags "
+                    "(id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
+        con.execute("CREATE TABLE IF NOT EXISTS post_tags "
+                    "(post_id INTEGER, tag_id INTEGER)")
+
+        tag_ids = dict(con.execute("SELECT name, id FROM tags"))
+
+        # A separate cursor is needed to insert while reading the posts
+        posts = con.cursor().execute(query, (min_id or 0,))
+        for batch in batches(posts, batch_size):
+            post_tags = []
+            for post_id, tags in batch:
+                if not tags:
+                    continue
+
+                # Tags are stored in the format "<tag1><tag2><tag3>"
+                for tag in tags[1:-1].split("><"):
+                    if tag not in tag_ids:
+                        tag_ids[tag] = len(tag_ids) + 1
+                        con.execute("INSERT INTO tags VALUES (?, ?)",
+                                    (tag_ids[tag], tag))
+                    post_tags.append((post_id, tag_ids[tag]))
+
+            con.executemany("INSERT INTO post_tags VALUES (?, ?)", post_tags)
+            row_count += len(post_tags)
+
+        con.execute("CREATE INDEX IF NOT EXISTS post_tags_post_id "
+                    "ON post_tags (post_id)")
+        con.execute("CREATE INDEX IF NOT EXISTS post_tags_tag_id "
+                    "ON post_tags (tag_id)")
+
+    report_rate("post_tags", row_count, time.time() - start_time)
+    return row_count
+
+
+def export_posts_parquet(con, directory, incremental=False,
+                         rows_per_file=1000000):
+    """Write the posts to a Parquet data set partitioned by year.
+
+    If incremental is set and the data set exists, only the posts with a
+    greater Id than those already in it are written, as new files.
+    Otherwise, the whole data set is written again.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    min_id = None
+    if incremental and os.path.isdir(directory):
+        # The data set may be missing the posts of imports that were done
+        # before format=parquet was set, so it is continued from its own
+        # last post rather than from the last import
+        ids = pq.read_table(directory, columns=["Id"]).to_pandas()["Id"]
+        if len(ids) > 0:
+            min_id = int(ids.max())
+
+    if min_id is None:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    query = ("SELECT Id, PostTypeId, ParentId, OwnerUserId, Tags, "
+             "CAST(SUBSTR(CreationDate, 1, 4) AS INTEGER) FROM posts "
+             "WHERE Id > ?")
+    names = ["Id", "PostTypeId", "ParentId", "OwnerUserId", "Tags", "year"]
+    types = [pa.int32(), pa.int8(), pa.int32(), pa.int32(), pa.string(),
+             pa.int16()]
+
+    row_count = 0
+    start_time = time.time()
+
+    for batch in batches(con.execute(query, (min_id or 0,)), rows_per_file):
+        columns = [pa.array(column, type=datatype)
+                   for column, datatype in zip(zip(*batch), types)]
+        table = pa.Table.from_arrays(columns, names=names)
+        pq.write_to_dataset(table, directory, partition_cols=["year"])
+        row_count += len(batch)
+
+    report_rate(directory, row_count, time.time() - start_time)
+    return row_count
+
+
+def import_table(con, filename, attribs, datatypes=None, indexes=(),
+                 batch_size=10000, workers=1, shard_size=64 * 2**20,
+                 table=None, replace=True, min_id=None, parser="etree"):
+    """Import the rows of an XML dump into a table.
+
+    With parser="etree", each row is parsed into an element. With
+    parser="scan", only the attributes in attribs are located in the raw
+    bytes and decoded, skipping large attributes that are not imported
+    (such as the Body of posts); this relies on the layout of the dump,
+    with one <row> per line and double-quoted attribute values. With
+    several workers, rows are always scanned.
+    """
+    if parser not in ("etree", "scan"):
+        raise ValueError("Unknown parser: %s" % parser)
 
-def import_table(con, filename, attribs, datatypes=None):
     if datatypes is None:
         colspec = attribs
     else:
@@ -37,23 +338,284 @@ def import_table(con, filename, attribs, datatypes=None):
 
     colspec = "(" + ", ".join(colspec) + ")"
 
-    with open(filename, encoding="utf-8") as f:
+    if table is None:
+        table = read_root_tag(filename)
+    insert = ("INSERT INTO " + table + " VALUES " +
+              "(" + ", ".join(["?"] * len(attribs)) + ")")
+
+    # With more than one worker, the file is split into shards that are
+    # parsed in parallel, while this process remains the only writer
+    if workers > 1:
+        rows = scan_rows_parallel(filename, attribs, workers, shard_size)
+    elif parser == "scan":
+        rows = scan_rows(filename, attribs, shard_size)
+    else:
+        rows = parse_rows(filename, attribs)
+
+    # Only rows newer than min_id are imported (the first attribute must
+    # be the row id)
+    if min_id is not None:
+        rows = (row for row in rows if int(row[0]) > min_id)
+
+    row_count = 0
+    start_time = time.time()
+
+    with con:
+        if replace:
+            con.execute("DROP TABLE IF EXISTS " + table)
+        con.execute("CREATE TABLE IF NOT EXISTS " + table + colspec)
+
+        for batch in batches(rows, batch_size):
+            con.executemany(insert, batch)
+            row_count += len(batch)
+
+        # Indexes are created only after all rows have been inserted,
+        # which is much faster than updating them on every insert
+        for column in indexes:
+            con.execute("CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)" %
+                        (table, column, table, column))
+
+    report_rate(table, row_count, time.time() - start_time)
+    return row_count
+
+
+def find_source(directory, name):
+    """Find the dump of a table, either extracted or compressed."""
+    candidates = [name + ".xml", name + ".xml.bz2", name + ".xml.gz",
+                  name + ".7z", "stackoverflow.com-" + name + ".7z"]
+    for candidate in candidates:
+        filename = os.path.join(directory, candidate)
+        if os.path.exists(filename):
+            return filename
+
+    raise FileNotFoundError("None of %s found in %s" %
+                            (", ".join(candidates), directory))
+
+
+def is_compressed(filename):
+    return os.path.splitext(filename)[1] in DECOMPRESSORS
+
+
+@contextmanager
+def open_source(filename):
+    """Open a dump as a binary stream, decompressing it if needed."""
+    if not is_compressed(filename):
+        with open(filename, "rb") as f:
+            yield f
+        return
+
+    command = find_decompressor(filename)
+    process = subprocess.Popen(command + [filename], stdout=subprocess.PIPE)
+    complete = False
+    try:
+        yield process.stdout
+        complete = not process.stdout.read(1)
+    finally:
+        # The reader may stop early, e.g. after reading the root tag
+        if not complete:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+
+    if complete and process.returncode != 0:
+        raise RuntimeError("%s failed with status %d while reading %s" %
+                           (command[0], process.returncode, filename))
+
+
+def find_decompressor(filename):
+    suffix = os.path.splitext(filename)[1]
+    for command in DECOMPRESSORS[suffix]:
+        if shutil.which(command[0]):
+            return command
+
+    raise RuntimeError("No decompressor found for %s; install one of %s" %
+                       (filename, ", ".join(command[0] for command
+                                            in DECOMPRESSORS[suffix])))
+
+
+def read_root_tag(filename):
+    with open_source(filename) as f:
+        _, root = next(ElementTree.iterparse(f, events=("start",)))
+        return root.tag
+
+
+def parse_rows(filename, attribs):
+    with open_source(filename) as f:
         iterparser = ElementTree.iterparse(f, events=("start", "end"))
         _, root = next(iterparser)
-        table = root.tag
 
-        with con:
-            con.execute("DROP TABLE IF EXISTS " + table)
-            con.execute("CREATE TABLE IF NOT EXISTS " + table + colspec)
+        for event, element in iterparser:
+            if event == "end" and element.tag == "row":
+                yield tuple(element.get(x) for x in attribs)
+
+                # Don't keep rows in memory after processing them
+                root.clear()
+
+
+def scan_rows(filename, attribs, block_size):
+    with open_source(filename) as f:
+        for block in read_blocks(f, block_size):
+            yield from scan_block(block, attribs)
+
+
+def scan_rows_parallel(filename, attribs, workers, shard_size):
+    # A compressed dump can't be split in advance, so it is read as a
+    # stream instead
+    if is_compressed(filename):
+        yield from scan_stream_parallel(filename, attribs, workers,
+                                        shard_size)
+        return
+
+    shards = ((filename, start, end, attribs)
+              for start, end in find_shards(filename, shard_size))
+
+    with Pool(workers) as pool:
+        for rows in map_bounded(pool, scan_shard, shards, 2 * workers):
+            yield from rows
+
+
+def scan_stream_parallel(filename, attribs, workers, block_size):
+    with open_source(filename) as f, Pool(workers) as pool:
+        blocks = ((block, attribs) for block in read_blocks(f, block_size))
+        for rows in map_bounded(pool, scan_block, blocks, 2 * workers):
+            yield from rows
+
+
+def map_bounded(pool, func, args, max_pending):
+    """Yield func(*a) for each a in args, in order, computed in the pool.
+
+    Unlike imap, this doesn't run ahead of the consumer, so the results
+    of at most max_pending tasks are held in memory at a time.
+    """
+    pending = deque()
+    for a in args:
+        pending.append(pool.apply_async(func, a))
+        if len(pending) > max_pending:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+def read_blocks(f, block_size):
+    """Read a stream in blocks that end on a <row boundary."""
+    buffer = b""
+    while True:
+        data = f.read(block_size)
+        if not data:
+            break
+
+        buffer += data
+        position = buffer.rfind(ROW_START)
+        if position > 0:
+            yield buffer[:position]
+            buffer = buffer[position:]
+
+    if buffer:
+        yield buffer
+
+
+def find_shards(filename, shard_size):
+    """Split a file into byte ranges that start on a <row boundary."""
+    size = os.path.getsize(filename)
+
+    with open(filename, "rb") as f:
+        boundaries = []
+        for offset in range(0, size, shard_size):
+            boundary = find_row_start(f, offset)
+            if boundary is not None and boundary not in boundaries:
+                boundaries.append(boundary)
+
+    return list(zip(boundaries, boundaries[1:] + [size]))
+
+
+def find_row_start(f, offset, window=2**20):
+    # A literal "<" is not allowed inside XML attribute values, so the
+    # first "<row" after the offset is always the start of a row
+    f.seek(offset)
+    overlap = b""
+    while True:
+        data = f.read(window)
+        if not data:
+            return None
+
+        data = overlap + data
+        position = data.find(ROW_START)
+        if position >= 0:
+            return offset - len(overlap) + position
+
+        offset += len(data) - len(overlap)
+        overlap = data[-(len(ROW_START) - 1):]
+
+
+def scan_shard(filename, start, end, attribs):
+    with open(filename, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    return scan_block(data, attribs)
+
+
+def scan_block(data, attribs):
+    """Extract the given attributes from each row in a block of XML.
+
+    The attributes are searched for directly in the block, without
+    copying the rows, so attributes that are not wanted are skipped over
+    but never decoded.
+    """
+    # A literal '"' is not allowed inside attribute values either, so
+    # ' Id="' can only be the start of the Id attribute
+    keys = [b' %s="' % x.encode() for x in attribs]
+
+    rows = []
+    end = data.find(ROW_START)
+    while end >= 0:
+        start = end
+        end = data.find(ROW_START, start + len(ROW_START))
+        stop = len(data) if end < 0 else end
+
+        row = []
+        for key in keys:
+            position = data.find(key, start, stop)
+            if position < 0:
+                row.append(None)
+            else:
+                position += len(key)
+                row.append(unescape(data[position:
+                                         data.index(b'"', position)]))
+        rows.append(tuple(row))
+
+    return rows
+
+
+def unescape(value):
+    if value is None:
+        return None
+    text = value.decode("utf-8")
+    if "&" not in text:
+        return text
+    if "&#" in text:
+        return html.unescape(text)
+
+    # Apart from character references, only the predefined XML entities
+    # can appear, as in the Tags of every question
+    return (text.replace("&lt;", "<").replace("&gt;", ">")
+            .replace("&quot;", '"').replace("&apos;", "'")
+            .replace("&amp;", "&"))
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
 
-            for event, element in iterparser:
-                if event == "end" and element.tag == "row":
-                    con.execute("INSERT INTO " + table + " VALUES " +
-                                "(" + ", ".join(["?"] * len(attribs)) + ")",
-                                [element.get(x) for x in attribs])
 
-                    # Don't keep rows in memory after processing them
-                    root.clear()
+def report_rate(table, row_count, elapsed):
+    print("Imported %d rows into %s in %.1f s (%.0f rows/s)" %
+          (row_count, table, elapsed, row_count / max(elapsed, 1e-9)))
 
 
 if __name__ == "__main__":
@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
 
-from collections import Counter
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import configparser
+import csv
+from functools import partial
+import re
 import sqlite3
+import threading
+import time
+import unicodedata
 
 import geopy
 import pandas as pd
 import pycountry
 from tqdm import tqdm
 
+import instrumentation
+
 # The ArcGIS geocoder in geopy does not return the country code,
 # so we replace it with a modified local copy that does
 import thirdparty.geopy.geocoders.arcgis
@@ -18,175 +27,652 @@ geopy.geocoders.ArcGIS = thirdparty.geopy.geocoders.arcgis.ArcGIS
 def main():
     config = configparser.ConfigParser()
     config.read("stacktrends.ini")
+    instrumentation.start("2_locations", config)
 
     # Read distinct locations from the database
-    con = sqlite3.connect(config["Database"]["filename"])
-    locations = pd.read_sql_query("SELECT DISTINCT Location FROM users", con)
-    locations = locations["Location"]
-    con.close()
-
-    # Drop locations that don't have any letters (most likely trash)
-    locations.where(locations.str.contains("[^\W\d_]"), inplace=True)
-    locations.dropna(inplace=True)
-
-    # Set up geocoders
-    # Google is disabled because it has a limit of 2500 queries per day
-    geocoders = [ArcGISCountryCoder(config),
-                 BingCountryCoder(config),
-                 #GoogleCountryCoder(config),
-                 NominatimCountryCoder(config)]
-
-    # Main loop: for each location, query all the configured geocoders
-    countries = pd.DataFrame(columns={"Location", "Country"})
-    for location in tqdm(locations):
-        candidate_countries = []
-        for geocoder in geocoders:
-            candidate_countries.append(geocoder.getCountry(location))
-
-        # Store a country for this location only if there is a majority
-        # of geocoders in agreement
-        most_common_country = Counter(candidate_countries).most_common(1)[0]
-        if most_common_country[1] > len(geocoders)/2:
-            countries = countries.append({"Location": location,
-                                          "Country": most_common_country[0]
-                                         }, ignore_index=True)
-
-    # Write the results to the SQLite database
-    con = sqlite3.connect(config["Database"]["filename"])
-    countries.to_sql("locations", con, if_exists="replace", index=False)
-    con.close()
+    with instrumentation.stage("read") as stage:
+        con = sqlite3.connect(config["Database"]["filename"])
+        locations = pd.read_sql_query("SELECT DISTINCT Location FROM users",
+                                      con)
+        locations = locations["Location"]
+        con.close()
+
+        # Drop locations that don't have any letters (most likely trash)
+        locations.where(locations.str.contains("[^\W\d_]"), inplace=True)
+        locations.dropna(inplace=True)
+        stage.rows = len(locations)
+
+    # Results are written as they are found. When resuming, locations
+    # that were processed by a previous run are skipped.
+    geocoding_config = config["Geocoding"]
+    writer = LocationWriter(config["Database"]["filename"],
+                            geocoding_config.getboolean("resume", False),
+                            int(geocoding_config.get("commit_every", 100)))
+    locations = locations[~locations.isin(writer.processed())]
+
+    # Locations that just name a country are resolved offline. The
+    # others are grouped by canonical form, and only one location of
+    # each group is sent to the geocoders.
+    with instrumentation.stage("normalize") as stage:
+        gazetteer = CountryGazetteer()
+        offline = locations.map(gazetteer.getCountry)
+        keys = locations.map(canonical_location)
+
+        residual = pd.isnull(offline)
+        writer.write(zip(locations[~residual], offline[~residual]))
+
+        groups = locations[residual].groupby(keys[residual])
+        queries = groups.first()
+        members = {key: list(group) for key, group in groups}
+        stage.rows = len(locations)
+
+    # Results of previous runs are reused from the cache (TTLs in days)
+    cache_config = config["GeocodingCache"]
+    cache = GeocodingCache(cache_config["filename"],
+                           float(cache_config.get("ttl", 365)) * 86400,
+                           float(cache_config.get("negative_ttl", 30)) * 86400)
+
+    # Set up geocoders. With offline_first, locations that the offline
+    # gazetteer resolves unambiguously are not sent to the geocoders.
+    geocoders = [COUNTRY_CODERS[name.strip()](config, cache)
+                 for name in geocoding_config["geocoders"].split(",")]
+    if geocoding_config.getboolean("offline_first", False):
+        offline_coder = GazetteerCountryCoder(config)
+    else:
+        offline_coder = None
+
+    # Main loop: for each location, query the configured geocoders until
+    # a majority is reached or becomes impossible. Many locations are
+    # queried concurrently, and each geocoder limits its own request rate.
+    workers = int(geocoding_config.get("workers", 1))
+    by_latency = geocoding_config.getboolean("order_by_latency", True)
+    with instrumentation.stage("geocode") as stage, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(partial(locate, geocoders,
+                                       offline_coder=offline_coder,
+                                       by_latency=by_latency),
+                               queries.values)
+        for key, (found, country) in tqdm(zip(queries.index, results),
+                                          total=len(queries)):
+            if found:
+                writer.write((location, country) for location in members[key])
+            elif found is not None:
+                writer.skip(members[key])
+            # Locations left undecided by geocoder errors are not recorded
+            # as processed, so they are queried again when resuming
+        stage.rows = len(queries)
+
+    cache.close()
+    writer.close()
+
+    instrumentation.record("geocoders", {geocoder.name: geocoder.metrics()
+                                         for geocoder in geocoders})
+    instrumentation.finish()
+
+
+def locate(geocoders, location, offline_coder=None, by_latency=False):
+    """Return (found, country) for a location.
+
+    A country is found only if there is a majority of geocoders in
+    agreement, or if offline_coder is given and it finds a country.
+    The geocoders are queried in order (fastest first if by_latency is
+    set, counting the wait for their rate limits), stopping as soon as
+    the outcome of the vote is known. A geocoder that fails does not
+    vote; if there is no majority without it, found is None, because
+    the outcome of the vote is not known.
+    """
+    if offline_coder is not None:
+        country = offline_coder.getCountry(location)
+        if country is not None:
+            return True, country
+
+    if by_latency:
+        geocoders = sorted(geocoders, key=lambda geocoder: geocoder.cost())
+
+    candidate_countries = Counter()
+    failed = False
+    for answered, geocoder in enumerate(geocoders, 1):
+        try:
+            candidate_countries[geocoder.getCountry(location)] += 1
+        except GeocodingError:
+            failed = True
 
+        if candidate_countries:
+            country, votes = candidate_countries.most_common(1)[0]
+        else:
+            country, votes = None, 0
+        if votes > len(geocoders)/2:
+            return True, country
 
-class CountryCoder:
-    def getCountry(self, location):
-        raise NotImplementedError
+        # Not even the remaining geocoders can make up a majority
+        if votes + len(geocoders) - answered <= len(geocoders)/2:
+            break
 
+    return (None if failed else False), None
+
+
+def location_parts(location):
+    """Split a location into case-folded parts, without punctuation."""
+    location = unicodedata.normalize("NFKC", location).casefold()
+
+    parts = []
+    for part in re.split(r"[,;/|]", location):
+        # "U.S.A." becomes "usa" and "St. John's" becomes "st johns"
+        part = re.sub(r"[.'’]", "", part)
+        part = " ".join(re.sub(r"[^\w\s]", " ", part).split())
+        if part:
+            parts.append(part)
+
+    return parts
+
+
+def canonical_location(location):
+    return ", ".join(location_parts(location))
 
-class ArcGISCountryCoder(CountryCoder):
-    def __init__(self, config):
-        config = config["ArcGISCountryCoder"]
-        timeout = float(config.get("timeout", 10))
-        self.retries = int(config.get("retries", 0))
 
-        self._geocoder = geopy.geocoders.ArcGIS(timeout=timeout)
+class CountryGazetteer:
+    """Offline lookup of locations that name a country.
+
+    A location is resolved if it is, or ends with, the name of a country
+    or a common alias. Names that could refer to more than one place are
+    ignored. ISO 3166 alpha-3 codes are only recognized in upper case.
+    """
+
+    ALIASES = {
+        "uk": "GBR", "great britain": "GBR", "britain": "GBR",
+        "england": "GBR", "scotland": "GBR", "wales": "GBR",
+        "northern ireland": "GBR",
+        "us": "USA", "usa": "USA", "united states of america": "USA",
+        "uae": "ARE", "holland": "NLD", "the netherlands": "NLD",
+        "russia": "RUS", "vietnam": "VNM", "czech republic": "CZE",
+        "turkey": "TUR", "ivory coast": "CIV", "macedonia": "MKD",
+        "deutschland": "DEU", "españa": "ESP", "brasil": "BRA",
+    }
+
+    # Country names that are also names of US states
+    AMBIGUOUS = {"georgia"}
+
+    def __init__(self):
+        names = defaultdict(set)
+        for name, alpha3 in self.countryNames():
+            names[name].add(alpha3)
+
+        self._names = {name: alpha3s.pop()
+                       for name, alpha3s in names.items()
+                       if len(alpha3s) == 1 and name not in self.AMBIGUOUS}
+        self._codes = {country.alpha_3 for country in pycountry.countries}
 
     def getCountry(self, location):
-        response = None
-        for attempt in range(self.retries + 1):
-            try:
-                response = self._geocoder.geocode(location,
-                                                  out_fields=("Country",))
-                break
-            except geopy.exc.GeocoderTimedOut as e:
-                if attempt < self.retries:
-                    continue
-                else:
-                    print("[ArcGIS] '%s':" % location, e)
-                    break
-            except geopy.exc.GeopyError as e:
-                print("[ArcGIS] '%s':" % location, e)
+        parts = location_parts(location)
+        if not parts:
+            return None
 
-        try:
-            return response.raw["attributes"]["Country"]
-        except (AttributeError, KeyError):
+        country = (self._names.get(", ".join(parts)) or
+                   self._names.get(parts[-1]))
+        if country is not None:
+            return country
+
+        code = re.split(r"[,;/|]", location)[-1].strip()
+        if code in self._codes:
+            return code
+
+        return None
+
+    @classmethod
+    def countryNames(cls):
+        """Yield (canonical name, alpha-3 code) for every country name."""
+        for country in pycountry.countries:
+            for attr in ("name", "official_name", "common_name"):
+                name = getattr(country, attr, None)
+                if name:
+                    yield canonical_location(name), country.alpha_3
+                    # e.g. "Korea, Republic of"
+                    yield (canonical_location(name.split(",")[0]),
+                           country.alpha_3)
+
+        for alias, alpha3 in cls.ALIASES.items():
+            yield canonical_location(alias), alpha3
+
+
+def normalize_location(location):
+    """Return the key under which a location is cached."""
+    location = unicodedata.normalize("NFKC", location).casefold()
+    return " ".join(location.split())
+
+
+class LocationWriter:
+    """Write geocoded locations to the locations table in batches.
+
+    Every processed location is also recorded in the locations_progress
+    table, including those for which no country was found, so that an
+    interrupted run can be resumed. Locations that could not be geocoded
+    because of errors should not be recorded, so that they are retried.
+    """
+
+    def __init__(self, filename, resume=False, commit_every=100):
+        self.commit_every = commit_every
+        self._pending = 0
+
+        self._con = sqlite3.connect(filename)
+        with self._con:
+            if not resume:
+                self._con.execute("DROP TABLE IF EXISTS locations")
+                self._con.execute("DROP TABLE IF EXISTS locations_progress")
+            self._con.execute("CREATE TABLE IF NOT EXISTS locations "
+                              "(Location TEXT, Country TEXT)")
+            self._con.execute("CREATE TABLE IF NOT EXISTS locations_progress "
+                              "(Location TEXT PRIMARY KEY)")
+
+    def processed(self):
+        return {row[0] for row in
+                self._con.execute("SELECT Location FROM locations_progress")}
+
+    def write(self, rows):
+        rows = list(rows)
+        self._con.executemany("INSERT INTO locations VALUES (?, ?)", rows)
+        self.skip(location for location, _ in rows)
+
+    def skip(self, locations):
+        self._con.executemany("INSERT OR IGNORE INTO locations_progress "
+                              "VALUES (?)", ((x,) for x in locations))
+
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self._con.commit()
+            self._pending = 0
+
+    def close(self):
+        self._con.commit()
+        self._con.close()
+
+
+class GeocodingCache:
+    """Persistent cache of geocoding results in an SQLite database.
+
+    Results are keyed by normalized location and geocoder. Locations
+    that were not found are cached for negative_ttl seconds, and found
+    ones for ttl seconds. Errors are never cached.
+    """
+
+    def __init__(self, filename, ttl, negative_ttl, commit_every=100):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.commit_every = commit_every
+        self._pending = 0
+
+        # The cache is shared by all the threads of the main loop
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(filename, check_same_thread=False)
+        self._con.execute("CREATE TABLE IF NOT EXISTS geocoding_cache "
+                          "(location TEXT, geocoder TEXT, country TEXT, "
+                          "status TEXT, timestamp REAL, "
+                          "PRIMARY KEY (location, geocoder))")
+
+    def get(self, geocoder, location):
+        """Return (country,) if a fresh result is cached, else None."""
+        with self._lock:
+            row = self._con.execute("SELECT country, status, timestamp "
+                                    "FROM geocoding_cache "
+                                    "WHERE location = ? AND geocoder = ?",
+                                    (normalize_location(location), geocoder)
+                                   ).fetchone()
+        if row is None:
             return None
 
+        country, status, timestamp = row
+        ttl = self.ttl if status == "ok" else self.negative_ttl
+        if time.time() - timestamp > ttl:
+            return None
 
-class BingCountryCoder(CountryCoder):
-    def __init__(self, config):
-        config = config["BingCountryCoder"]
-        api_key = config["api_key"]
-        timeout = float(config.get("timeout", 10))
+        return (country,)
+
+    def put(self, geocoder, location, country):
+        status = "ok" if country is not None else "not_found"
+        with self._lock:
+            self._con.execute("INSERT OR REPLACE INTO geocoding_cache "
+                              "VALUES (?, ?, ?, ?, ?)",
+                              (normalize_location(location), geocoder,
+                               country, status, time.time()))
+
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self._con.commit()
+                self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._con.commit()
+            self._con.close()
+
+
+class TokenBucket:
+    """Rate limiter allowing rate requests per second on average, in
+    bursts of up to burst requests. A rate of 0 disables the limit."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def interval(self):
+        """Return the mean number of seconds between requests."""
+        return 1 / self.rate if self.rate > 0 else 0.0
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._last) * self.rate)
+                self._last = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class GeocodingError(Exception):
+    """Raised by CountryCoder.getCountry when a geocoder fails."""
+
+
+class CountryCoder:
+    name = None
+
+    # Errors that will happen again however many times the query is
+    # retried, so they are reported at once. They are all subclasses of
+    # GeocoderServiceError, so they are caught before retryable_errors.
+    fatal_errors = (geopy.exc.GeocoderAuthenticationFailure,
+                    geopy.exc.GeocoderInsufficientPrivileges,
+                    geopy.exc.GeocoderQueryError)
+
+    # Errors that may not happen again if the query is retried
+    retryable_errors = (geopy.exc.GeocoderTimedOut,
+                        geopy.exc.GeocoderUnavailable,
+                        geopy.exc.GeocoderServiceError)
+
+    def __init__(self, config, cache=None):
+        config = config[type(self).__name__]
+        self.timeout = float(config.get("timeout", 10))
         self.retries = int(config.get("retries", 0))
+        self.backoff = float(config.get("backoff", 0))
+        # Seconds to wait before retrying a query once when the quota of
+        # the provider is exceeded (0 gives up at once)
+        self.quota_wait = float(config.get("quota_wait", 0))
+        self.cache = cache
+
+        # Requests per second allowed by the provider
+        self.rate_limiter = TokenBucket(float(config.get("rate_limit", 0)),
+                                        int(config.get("burst", 1)))
 
-        self._geocoder = geopy.geocoders.Bing(api_key, timeout=timeout)
+        # Another endpoint (e.g. a local test server) can be configured
+        # in place of the provider's API
+        self.api = config.get("api")
+
+        # Moving average of the time taken by each query, in seconds
+        self.latency = 0.0
+
+        # Request and error counts and the total latency, for the report
+        self.counts = Counter()
+        self._lock = threading.Lock()
 
     def getCountry(self, location):
+        if self.cache is not None:
+            cached = self.cache.get(self.name, location)
+            if cached is not None:
+                self.count("cache_hits")
+                return cached[0]
+
         response = None
+        quota_retried = False
         for attempt in range(self.retries + 1):
+            self.rate_limiter.acquire()
+            self.count("requests")
             try:
-                response = self._geocoder.geocode(location,
-                                                  include_country_code=True)
+                start_time = time.monotonic()
+                response = self.query(location)
+                self.updateLatency(time.monotonic() - start_time)
                 break
-            except geopy.exc.GeocoderTimedOut as e:
+            except self.fatal_errors as e:
+                self.count("errors")
+                print("[%s] '%s':" % (self.name, location), e)
+                raise GeocodingError(location) from e
+            except geopy.exc.GeocoderQuotaExceeded as e:
+                self.count("errors")
+                # Backing off for a few seconds is of no use against a
+                # quota, so it is retried only once, after quota_wait
+                if (self.quota_wait > 0 and not quota_retried and
+                        attempt < self.retries):
+                    quota_retried = True
+                    time.sleep(self.quota_wait)
+                    continue
+                else:
+                    print("[%s] '%s':" % (self.name, location), e)
+                    raise GeocodingError(location) from e
+            except self.retryable_errors as e:
+                self.count("errors")
                 if attempt < self.retries:
+                    # Exponential backoff before trying again
+                    time.sleep(self.backoff * 2**attempt)
                     continue
                 else:
-                    print("[Bing] '%s':" % location, e)
-                    break
+                    # Errors are not cached, so the location will be
+                    # queried again in the next run
+                    print("[%s] '%s':" % (self.name, location), e)
+                    raise GeocodingError(location) from e
             except geopy.exc.GeopyError as e:
-                print("[Bing] '%s':" % location, e)
+                self.count("errors")
+                print("[%s] '%s':" % (self.name, location), e)
+                raise GeocodingError(location) from e
 
         try:
-            alpha2 = response.raw["address"]["countryRegionIso2"]
-            return pycountry.countries.get(alpha_2=alpha2).alpha_3
-        except (AttributeError, KeyError):
-            return None
+            country = self.parseCountry(response)
+        except (AttributeError, KeyError, TypeError):
+            country = None
+
+        if self.cache is not None:
+            self.cache.put(self.name, location, country)
+
+        return country
+
+    def updateLatency(self, seconds, weight=0.2):
+        with self._lock:
+            self.counts["latency"] += seconds
+            if self.latency == 0:
+                self.latency = seconds
+            else:
+                self.latency += weight * (seconds - self.latency)
+
+    def cost(self):
+        """Return the expected number of seconds taken by a query.
+
+        The latency is measured once the rate limiter lets the query
+        through, so the time spent waiting for it is added separately.
+        Otherwise, a fast geocoder limited to one request per second
+        would be queried first and hold back every other location.
+        """
+        return self.latency + self.rate_limiter.interval()
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def metrics(self):
+        with self._lock:
+            successful = self.counts["requests"] - self.counts["errors"]
+            return {
+                "requests": self.counts["requests"],
+                "errors": self.counts["errors"],
+                "cache_hits": self.counts["cache_hits"],
+                "mean_latency": round(self.counts["latency"] /
+                                      max(successful, 1), 4),
+            }
+
+    def useGeocoder(self, geocoder):
+        if self.api:
+            geocoder.api = self.api
+        self._geocoder = geocoder
+
+    def query(self, location):
+        raise NotImplementedError
 
+    def parseCountry(self, response):
+        raise NotImplementedError
 
-class GoogleCountryCoder(CountryCoder):
-    def __init__(self, config):
-        config = config["GoogleCountryCoder"]
-        timeout = float(config.get("timeout", 10))
-        self.retries = int(config.get("retries", 0))
 
-        self._geocoder = geopy.geocoders.GoogleV3(timeout=timeout)
+class GazetteerCountryCoder(CountryCoder):
+    """Offline country coder using a local gazetteer.
+
+    The gazetteer has the names of countries, of their first-level
+    subdivisions (from pycountry) and of major cities (from a CSV file
+    with name and country columns), indexed by their canonical form.
+    Each part of a location is split into the longest known names, and
+    a location with a part that is not made up entirely of known names
+    is not resolved. A country is returned only if all the names found
+    agree on it; names of places in more than one country are ignored.
+    """
+
+    name = "Gazetteer"
+
+    SUBDIVISION_TYPES = {
+        "Administrative region", "Autonomous community",
+        "Autonomous region", "Canton", "Country", "Federal district",
+        "Land", "Metropolitan region", "Prefecture", "Province", "Region",
+        "Republic", "State", "Territory", "Union territory", "Voivodship",
+    }
+
+    def __init__(self, config, cache=None):
+        super().__init__(config, cache)
+        filename = config[type(self).__name__].get("filename",
+                                                   "gazetteer.csv")
+
+        places = defaultdict(set)
+        for name, alpha3 in CountryGazetteer.countryNames():
+            places[name].add(alpha3)
+
+        for subdivision in pycountry.subdivisions:
+            if (subdivision.parent_code is None and
+                    subdivision.type in self.SUBDIVISION_TYPES):
+                alpha3 = pycountry.countries.get(
+                    alpha_2=subdivision.country_code).alpha_3
+                places[canonical_location(subdivision.name)].add(alpha3)
+
+        with open(filename, encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                places[canonical_location(row["name"])].add(row["country"])
+
+        # Ambiguous names are kept in the index (as None), so that they
+        # are still matched as a whole instead of by their parts
+        self._index = {name: alpha3s.pop() if len(alpha3s) == 1 else None
+                       for name, alpha3s in places.items() if name}
+        self._max_tokens = max(len(name.split()) for name in self._index)
 
     def getCountry(self, location):
-        response = None
-        for attempt in range(self.retries + 1):
-            try:
-                response = self._geocoder.geocode(location)
-                break
-            except geopy.exc.GeocoderTimedOut as e:
-                if attempt < self.retries:
-                    continue
+        countries = set()
+        for part in location_parts(location):
+            tokens = part.split()
+            start = 0
+            while start < len(tokens):
+                # Longest match first
+                for end in range(min(len(tokens), start + self._max_tokens),
+                                 start, -1):
+                    phrase = " ".join(tokens[start:end])
+                    if phrase in self._index:
+                        if self._index[phrase] is not None:
+                            countries.add(self._index[phrase])
+                        start = end
+                        break
                 else:
-                    print("[Google] '%s':" % location, e)
-                    break
-            except geopy.exc.GeopyError as e:
-                print("[Google] '%s':" % location, e)
+                    # A word that is not part of any known name may belong
+                    # to an unknown place (e.g. "Jersey City"), so the
+                    # location is left to the other geocoders
+                    return None
 
-        try:
-            for component in response.raw["address_components"]:
-                if "country" in component.get("types", []):
-                    alpha2 = component["short_name"]
-                    return pycountry.countries.get(alpha_2=alpha2).alpha_3
-        except (AttributeError, KeyError):
-            pass
+        if len(countries) == 1:
+            return countries.pop()
+
+        return None
+
+
+class ArcGISCountryCoder(CountryCoder):
+    name = "ArcGIS"
+
+    def __init__(self, config, cache=None):
+        super().__init__(config, cache)
+        self.useGeocoder(geopy.geocoders.ArcGIS(timeout=self.timeout))
+
+    def query(self, location):
+        return self._geocoder.geocode(location, out_fields=("Country",))
+
+    def parseCountry(self, response):
+        return response.raw["attributes"]["Country"]
+
+
+class BingCountryCoder(CountryCoder):
+    name = "Bing"
+
+    def __init__(self, config, cache=None):
+        super().__init__(config, cache)
+        api_key = config[type(self).__name__]["api_key"]
+        self.useGeocoder(geopy.geocoders.Bing(api_key, timeout=self.timeout))
+
+    def query(self, location):
+        return self._geocoder.geocode(location, include_country_code=True)
+
+    def parseCountry(self, response):
+        alpha2 = response.raw["address"]["countryRegionIso2"]
+        return pycountry.countries.get(alpha_2=alpha2).alpha_3
+
+
+class GoogleCountryCoder(CountryCoder):
+    name = "Google"
+
+    def __init__(self, config, cache=None):
+        super().__init__(config, cache)
+        self.useGeocoder(geopy.geocoders.GoogleV3(timeout=self.timeout))
+
+    def query(self, location):
+        return self._geocoder.geocode(location)
+
+    def parseCountry(self, response):
+        for component in response.raw["address_components"]:
+            if "country" in component.get("types", []):
+                alpha2 = component["short_name"]
+                return pycountry.countries.get(alpha_2=alpha2).alpha_3
 
         return None
 
 
 class NominatimCountryCoder(CountryCoder):
-    def __init__(self, config):
-        config = config["NominatimCountryCoder"]
-        timeout = float(config.get("timeout", 10))
-        self.retries = int(config.get("retries", 0))
+    name = "Nominatim"
 
-        self._geocoder = geopy.geocoders.Nominatim(timeout=timeout)
+    def __init__(self, config, cache=None):
+        super().__init__(config, cache)
+        self.useGeocoder(geopy.geocoders.Nominatim(timeout=self.timeout))
 
-    def getCountry(self, location):
-        response = None
-        for attempt in range(self.retries + 1):
-            try:
-                response = self._geocoder.geocode(location,
-                                                  addressdetails=True)
-                break
-            except geopy.exc.GeocoderTimedOut as e:
-                if attempt < self.retries:
-                    continue
-                else:
-                    print("[Nominatim] '%s':" % location, e)
-                    break
-            except geopy.exc.GeopyError as e:
-                print("[Nominatim] '%s':" % location, e)
+    def query(self, location):
+        return self._geocoder.geocode(location, addressdetails=True)
 
-        try:
-            alpha2 = response.raw["address"]["country_code"].upper()
-            return pycountry.countries.get(alpha_2=alpha2).alpha_3
-        except (AttributeError, KeyError):
-            return None
+    def parseCountry(self, response):
+        alpha2 = response.raw["address"]["country_code"].upper()
+        return pycountry.countries.get(alpha_2=alpha2).alpha_3
+
+
+COUNTRY_CODERS = {
+    "Gazetteer": GazetteerCountryCoder,
+    "ArcGIS": ArcGISCountryCoder,
+    "Bing": BingCountryCoder,
+    "Google": GoogleCountryCoder,
+    "Nominatim": NominatimCountryCoder,
+}
 
 
 if __name__ == "__main__":
@@ -1,87 +1,604 @@
 #!/usr/bin/env python3
 
 import configparser
+from functools import partial
+import gzip
+import hashlib
+from itertools import chain
+import json
+from multiprocessing import Pool
 import os
 import sqlite3
+import sys
 
 import numpy as np
 import pandas as pd
 import pycountry
+from scipy import sparse
+
+import instrumentation
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Posts sorted by user, so that all posts of a user are read
+# consecutively. Their tags are looked up in a TagIndex.
+CHUNKED_POSTS_QUERY = """
+    SELECT p.Id, p.PostTypeId, p.ParentId,
+           CAST(SUBSTR(p.CreationDate, 1, 4) AS INTEGER) AS year,
+           p.OwnerUserId AS user, l.Country AS country
+    FROM posts p
+    LEFT JOIN users u ON u.Id = p.OwnerUserId
+    LEFT JOIN locations l ON l.Location = u.Location
+    ORDER BY p.OwnerUserId
+"""
+
+TAGGED_POSTS_QUERY = """
+    SELECT Id, Tags FROM posts WHERE Tags IS NOT NULL ORDER BY Id
+"""
+
+COUNTRIES_QUERY = """
+    SELECT l.Country AS country, COUNT(*) AS users
+    FROM users u JOIN locations l ON l.Location = u.Location
+    WHERE l.Country IS NOT NULL
+    GROUP BY l.Country
+"""
+
+# One row per tag of each post, with the clean tag names of the temporary
+# tag_names table created by create_tag_names()
+POST_TAGS_QUERY = """
+    SELECT pt.post_id AS post,
+           CAST(SUBSTR(p.CreationDate, 1, 4) AS INTEGER) AS year,
+           p.OwnerUserId AS user,
+           l.Country AS country, n.newname AS tag
+    FROM post_tags pt
+    JOIN tag_names n ON n.tag_id = pt.tag_id
+    JOIN posts p ON p.Id = pt.post_id
+    LEFT JOIN users u ON u.Id = p.OwnerUserId
+    LEFT JOIN locations l ON l.Location = u.Location
+"""
+
+# Missing ids in integer columns, which can't hold NaN
+NO_ID = -1
+
+# Outputs that can be created separately, e.g. "3_create-datasets.py tags"
+OUTPUTS = ("tags", "countries", "counts")
 
 
 def main():
     config = configparser.ConfigParser()
     config.read("stacktrends.ini")
+    datasets_config = config["Datasets"]
+    outputs = sys.argv[1:] or OUTPUTS
+    unknown = set(outputs) - set(OUTPUTS)
+    if unknown:
+        sys.exit("Unknown outputs: %s (choose from %s)" %
+                 (", ".join(sorted(unknown)), ", ".join(OUTPUTS)))
+
+    instrumentation.start("3_create-datasets", config)
+
+    selected_tags = get_selected_tags(config)
+    matrix_options = {
+        "level": datasets_config.get("tag_matrix_level", "user"),
+        "by_year": datasets_config.getboolean("tag_matrix_by_year", False),
+        "slices": [column.strip() for column in datasets_config.get(
+            "tag_matrix_slices", "").split(",") if column.strip()],
+    }
+    unknown = set(matrix_options["slices"]) - {"year", "country"}
+    if unknown:
+        sys.exit("Unknown tag_matrix_slices: %s (choose from year, country)"
+                 % ", ".join(sorted(unknown)))
+    top_k = int(datasets_config.get("tag_matrix_top_k", 0)) or None
+
+    # Posts can be read from the Parquet data set written by the import
+    # step; the SQLite database is used if it does not exist
+    parquet_directory = None
+    intermediate_config = config["Intermediate"]
+    if intermediate_config.get("format", "sqlite") == "parquet":
+        if os.path.isdir(intermediate_config["directory"]):
+            parquet_directory = intermediate_config["directory"]
+        else:
+            print("%s not found, reading posts from the database" %
+                  intermediate_config["directory"])
 
-    # Read in all tables
     con = sqlite3.connect(config["Database"]["filename"])
-    locations = pd.read_sql_query("SELECT * FROM locations", con)
-    users = pd.read_sql_query("SELECT * FROM users", con, "Id")
-    posts = pd.read_sql_query("SELECT * FROM posts", con, "Id",
-                              parse_dates=["CreationDate"])
+    engine = datasets_config.get("engine", "memory")
+    if "counts" not in outputs:
+        # The posts are not needed for the other outputs
+        datasets = {"countries": add_country_names(
+            pd.read_sql_query(COUNTRIES_QUERY, con, "country"))}
+    elif engine == "chunked":
+        chunk_size = int(datasets_config.get("chunk_size", 1000000))
+        datasets = create_datasets_chunked(con, selected_tags, chunk_size,
+                                           matrix_options)
+    elif engine == "sql":
+        datasets = create_datasets_sql(con, selected_tags, matrix_options)
+    elif engine == "partitioned":
+        workers = int(datasets_config.get("workers", os.cpu_count()))
+        cache_directory = datasets_config.get("partials_directory") or None
+        datasets = create_datasets_partitioned(
+            con, config["Database"]["filename"], selected_tags, workers,
+            matrix_options, cache_directory)
+    else:
+        datasets = create_datasets(con, selected_tags, matrix_options,
+                                   parquet_directory)
     con.close()
 
+    with instrumentation.stage("write"):
+        write_datasets(datasets, selected_tags, outputs, top_k)
+
+    instrumentation.finish()
+
+
+def write_datasets(datasets, selected_tags, outputs=OUTPUTS, top_k=None):
+    os.chdir("data")
+
+    # List of tags
+    if "tags" in outputs:
+        selected_tags["newname"].to_json("tags.json", orient="values")
+
+    # list of countries
+    if "countries" in outputs:
+        datasets["countries"].to_json("countries.json", orient="index")
+
+    if "counts" not in outputs:
+        return
+
+    # Count and relative frequency of tags by year (line chart)
+    datasets["tag_year"].to_csv("tag_year.csv")
+
+    # Count and relative frequency of tags by country, including the
+    # worldwide count as country "XXX" (bar chart / choropleth)
+    datasets["country_tag"].to_csv("country_tag.csv")
+
+    # Tag co-occurrence matrix (chord diagram), optionally also by year.
+    # The matrices sliced by year or country are only written in the
+    # compact form below.
+    for year, matrix in datasets["tag_matrices"].items():
+        if year == "all":
+            matrix.to_json("tag_matrix.json")
+        elif not is_sliced(year):
+            matrix.to_json("tag_matrix_%s.json" % year)
+
+    # Compact versions of the data sets above, as loaded by the web app
+    for name, data in compact_datasets(datasets, selected_tags["newname"],
+                                       top_k).items():
+        write_compact(name, data)
+
+    # Count by country, tag and year, queried by serve-cube.py
+    write_cube("country_tag_year",
+               *count_cube(datasets, selected_tags["newname"]))
+
+
+def create_datasets(con, selected_tags, matrix_options={},
+                    parquet_directory=None):
+    # Read in all tables
+    with instrumentation.stage("read") as stage:
+        locations = pd.read_sql_query("SELECT * FROM locations", con)
+        users = pd.read_sql_query("SELECT * FROM users", con, "Id")
+        if parquet_directory is None:
+            posts = pd.read_sql_query(
+                "SELECT Id, PostTypeId, ParentId, OwnerUserId, Tags, "
+                "CAST(SUBSTR(CreationDate, 1, 4) AS INTEGER) AS year "
+                "FROM posts", con, "Id")
+        else:
+            posts = read_posts_parquet(parquet_directory)
+        posts = compact_posts(posts)
+        stage.rows = len(posts)
+
     #
     # Prepare data
     #
 
-    users = merge_users_countries(users, locations)
-    posts = merge_posts_countries(posts, users)
-
-    posts["year"] = posts["CreationDate"].dt.strftime("%Y")
-    posts = explode_tags(posts)
+    with instrumentation.stage("prepare") as stage:
+        users = merge_users_countries(users, locations)
+        posts = merge_posts_countries(posts, users)
 
-    # Clean up tag names
-    selected_tags = get_selected_tags(config)
-    posts = posts.merge(selected_tags, "left", left_on="tag", right_index=True)
-    posts.drop("tag", axis=1, inplace=True)
-    posts.rename(columns={"newname": "tag"}, inplace=True)
-    posts.loc[:, "tag"] = posts["tag"].where(pd.notnull(posts["tag"]), "Other")
+        posts = explode_tags(posts, selected_tags)
+        stage.rows = len(posts)
 
     #
     # Create final data sets
     #
 
-    os.chdir("data")
+    with instrumentation.stage("summaries"):
+        country_tag_year = posts.groupby(["country", "tag", "year"]).size()
+        country_tag = count_table(
+            country_tag_year.groupby(level=["country", "tag"]).sum(),
+            freq=True, freq_by="country")
+        worldwide_tag = summary_table(posts, group_by=["tag"], freq=True)
+        tag_year = summary_table(posts, group_by=["tag", "year"], freq=True,
+                                 freq_by="year")
 
-    # List of tags
-    selected_tags["newname"].to_json("tags.json", orient="values")
+    with instrumentation.stage("matrices"):
+        matrices = tag_matrices(posts, **matrix_options)
 
-    # list of countries
-    country_table(users).to_json("countries.json", orient="index")
+    return {
+        "countries": country_table(users),
+        "tag_year": tag_year,
+        "country_tag": append_worldwide(country_tag, worldwide_tag),
+        "country_tag_year": country_tag_year,
+        "tag_matrices": matrices,
+    }
+
+
+def create_datasets_chunked(con, selected_tags, chunk_size,
+                            matrix_options={}):
+    """Create the data sets reading at most chunk_size posts at a time.
+
+    Only the counts, and a TagIndex with the tags of the questions, are
+    kept in memory between chunks. Since the posts are sorted by user,
+    the tags of a user are complete once a chunk with a different user
+    is read, so the posts of the last user in each chunk are carried
+    over to the next one.
+    """
+    tag_year = None
+    country_tag_year = None
+    matrices = None
+    carry = None
+
+    # All the tags of a post are always read in the same chunk
+    by_post = matrix_options.get("level") == "post"
+
+    with instrumentation.stage("tag_index") as stage:
+        tag_index = TagIndex.from_chunks(
+            ((chunk.index.values, chunk["Tags"]) for chunk
+             in pd.read_sql_query(TAGGED_POSTS_QUERY, con, "Id",
+                                  chunksize=chunk_size)),
+            selected_tags)
+        stage.rows = len(tag_index.ids)
+
+    with instrumentation.stage("chunks") as stage:
+        stage.rows = 0
+        for chunk in pd.read_sql_query(CHUNKED_POSTS_QUERY, con, "Id",
+                                       chunksize=chunk_size):
+            stage.rows += len(chunk)
+
+            # Rows are only in user order as returned by the query
+            last_user = chunk["user"].iloc[-1]
+
+            posts = tag_index.explode(chunk, chunk["PostTypeId"].values,
+                                      chunk["ParentId"].fillna(NO_ID).values)
+            if len(posts) == 0:
+                continue
+
+            tag_year = add_counts(tag_year,
+                                  posts.groupby(["tag", "year"]).size())
+            country_tag_year = add_counts(
+                country_tag_year,
+                posts.groupby(["country", "tag", "year"]).size())
+
+            if by_post:
+                matrices = add_matrices(matrices,
+                                        tag_matrices(posts, **matrix_options))
+                continue
+
+            user_posts = posts[posts["user"] >= 0]
+            if carry is not None:
+                user_posts = pd.concat([carry, user_posts])
+            carry = user_posts[user_posts["user"] == last_user]
+            complete = user_posts[user_posts["user"] != last_user]
+            if len(complete) > 0:
+                matrices = add_matrices(
+                    matrices, tag_matrices(complete, **matrix_options))
+
+    if carry is not None and len(carry) > 0:
+        matrices = add_matrices(matrices,
+                                tag_matrices(carry, **matrix_options))
+
+    # Tags of posts with a country are counted in both tables, so the
+    # worldwide count can be derived from the tag by year count
+    worldwide_tag = tag_year.groupby(level="tag").sum()
+    country_tag = country_tag_year.groupby(level=["country", "tag"]).sum()
+
+    countries = pd.read_sql_query(COUNTRIES_QUERY, con, "country")
+
+    return {
+        "countries": add_country_names(countries),
+        "tag_year": count_table(tag_year, freq=True, freq_by="year"),
+        "country_tag": append_worldwide(
+            count_table(country_tag, freq=True, freq_by="country"),
+            count_table(worldwide_tag, freq=True)),
+        "country_tag_year": country_tag_year,
+        "tag_matrices": {key: integer_counts(matrix)
+                         for key, matrix in matrices.items()},
+    }
+
+
+def create_datasets_sql(con, selected_tags, matrix_options={}):
+    """Create the data sets with aggregate queries on the post_tags table.
+
+    Only the aggregated counts are loaded into pandas.
+    """
+    with instrumentation.stage("queries") as stage:
+        create_tag_names(con, selected_tags)
+        tag_year, country_tag_year, unit_tags = aggregate_post_tags(
+            con, matrix_options.get("level"))
+        stage.rows = len(unit_tags)
+
+    with instrumentation.stage("matrices"):
+        matrices = tag_matrices(unit_tags, **matrix_options)
+
+    worldwide_tag = tag_year.groupby(level="tag").sum()
+    country_tag = country_tag_year.groupby(level=["country", "tag"]).sum()
+
+    countries = pd.read_sql_query(COUNTRIES_QUERY, con, "country")
+
+    return {
+        "countries": add_country_names(countries),
+        "tag_year": count_table(tag_year, freq=True, freq_by="year"),
+        "country_tag": append_worldwide(
+            count_table(country_tag, freq=True, freq_by="country"),
+            count_table(worldwide_tag, freq=True)),
+        "country_tag_year": country_tag_year,
+        "tag_matrices": matrices,
+    }
+
+
+def create_datasets_partitioned(con, filename, selected_tags, workers,
+                                matrix_options={}, cache_directory=None):
+    """Create the data sets from partial counts computed for each year.
+
+    The partial counts of each year are computed in a separate process,
+    with the queries of create_datasets_sql(), and added up in the end.
+    If cache_directory is given, the partial counts are stored there and
+    only the years without a valid partial or listed in dirty_years are
+    computed again.
+    """
+    level = matrix_options.get("level")
+    slices = matrix_options.get("slices", [])
+    years = [int(year) for year, in con.execute(
+        "SELECT DISTINCT SUBSTR(CreationDate, 1, 4) FROM posts")]
+
+    partials = {}
+    if cache_directory is not None:
+        os.makedirs(cache_directory, exist_ok=True)
+        key = partials_key(con, selected_tags, level, slices)
+        dirty = {int(year) for year, in con.execute(
+            "SELECT year FROM dirty_years")}
+        for year in set(years) - dirty:
+            cached = read_partial(cache_directory, year, key)
+            if cached is not None:
+                partials[year] = cached
+
+    missing = [year for year in years if year not in partials]
+    computed = []
+    with instrumentation.stage("partials") as stage:
+        if missing:
+            with Pool(min(workers, len(missing))) as pool:
+                computed = pool.map(partial(year_partial, filename,
+                                            selected_tags, level, slices),
+                                    missing)
+        stage.rows = len(missing)
+
+    for year, year_partial_counts in zip(missing, computed):
+        partials[year] = year_partial_counts
+        if cache_directory is not None:
+            pd.to_pickle((key, year_partial_counts),
+                         os.path.join(cache_directory, "%d.pickle" % year))
+
+    if cache_directory is not None:
+        with con:
+            con.execute("DELETE FROM dirty_years")
+            con.execute("DELETE FROM dirty_users")
+
+    #
+    # Reduce
+    #
+
+    with instrumentation.stage("reduce"):
+        tag_year = None
+        country_tag_year = None
+        matrices = {}
+
+        for year in sorted(partials):
+            counts = partials[year]
+            tag_year = add_counts(
+                tag_year, pd.concat({year: counts["tag"]}, names=["year"])
+                            .reorder_levels(["tag", "year"]))
+            country_tag_year = add_counts(
+                country_tag_year,
+                pd.concat({year: counts["country_tag"]}, names=["year"])
+                  .reorder_levels(["country", "tag", "year"]))
+            matrices[year] = counts["matrix"]
+
+        # Users are counted once in the matrix of all years, so it is created
+        # from the distinct tags of each user in each year
+        sliced = {}
+        if level == "post":
+            total = None
+            for year in sorted(partials):
+                total = add_counts(total, matrices[year])
+                sliced = add_matrices(sliced, partials[year]["slices"])
+            all_years = integer_counts(total)
+        else:
+            user_tags = pd.concat(
+                [partials[year]["user_tags"] for year in sorted(partials)])
+            all_years = tag_matrix(user_tags)
+            for column in slices:
+                sliced["by_" + column] = tag_slices(user_tags, column)
+
+        if not matrix_options.get("by_year"):
+            matrices = {}
+        matrices["all"] = all_years
+        matrices.update({key: integer_counts(counts)
+                         for key, counts in sliced.items()})
+
+    worldwide_tag = tag_year.groupby(level="tag").sum()
+    country_tag = country_tag_year.groupby(level=["country", "tag"]).sum()
+
+    countries = pd.read_sql_query(COUNTRIES_QUERY, con, "country")
+
+    return {
+        "countries": add_country_names(countries),
+        "tag_year": count_table(tag_year, freq=True, freq_by="year"),
+        "country_tag": append_worldwide(
+            count_table(country_tag, freq=True, freq_by="country"),
+            count_table(worldwide_tag, freq=True)),
+        "country_tag_year": country_tag_year,
+        "tag_matrices": matrices,
+    }
+
+
+def year_partial(filename, selected_tags, level, slices, year):
+    """Compute the partial counts of the posts created in a year."""
+    con = sqlite3.connect(filename)
+    create_tag_names(con, selected_tags)
+    tag_year, country_tag_year, unit_tags = aggregate_post_tags(con, level,
+                                                                year)
+    con.close()
+
+    counts = {
+        "tag": tag_year.reset_index("year", drop=True),
+        "country_tag": country_tag_year.reset_index("year", drop=True),
+        "matrix": tag_matrix(unit_tags, level),
+    }
+
+    # Posts are only counted in one year, so their counts by slice can be
+    # added up, but those of users are created from all their tags
+    if level == "post":
+        counts["slices"] = {"by_" + column: tag_slices(unit_tags, column,
+                                                       level)
+                            for column in slices}
+    else:
+        unit_tags["user"] = unit_tags["user"].astype(np.int32)
+        unit_tags["year"] = unit_tags["year"].astype(np.int16)
+        for column in ("country", "tag"):
+            unit_tags[column] = unit_tags[column].astype("category")
+        counts["user_tags"] = unit_tags[["user", "year", "country", "tag"]]
+
+    return counts
+
+
+def partials_key(con, selected_tags, level, slices=()):
+    # Partial counts must be computed again if the selected tags, the
+    # matrix level or slices or the geocoded locations change. Changes to
+    # the posts and users are tracked by year in dirty_years instead (a
+    # full import marks every year).
+    locations = hashlib.sha256()
+    for row in con.execute("SELECT Location, Country FROM locations "
+                           "ORDER BY Location, Country"):
+        locations.update(repr(row).encode())
+
+    return (tuple(selected_tags["newname"].items()), level, tuple(slices),
+            locations.hexdigest())
+
+
+def read_partial(directory, year, key):
+    filename = os.path.join(directory, "%d.pickle" % year)
+    if not os.path.exists(filename):
+        return None
+
+    cached_key, counts = pd.read_pickle(filename)
+    return counts if cached_key == key else None
+
+
+def create_tag_names(con, selected_tags):
+    with con:
+        con.execute("DROP TABLE IF EXISTS temp.tag_names")
+        con.execute("CREATE TEMP TABLE tag_names "
+                    "(tag_id INTEGER PRIMARY KEY, newname TEXT)")
+        con.executemany("INSERT INTO tag_names "
+                        "SELECT id, ? FROM tags "
+                        "WHERE name = ?",
+                        [(newname, tag) for tag, newname
+                         in selected_tags["newname"].items()])
+        con.execute("INSERT INTO tag_names "
+                    "SELECT id, 'Other' FROM tags "
+                    "WHERE id NOT IN (SELECT tag_id FROM tag_names)")
+
+
+def aggregate_post_tags(con, level=None, year=None):
+    """Count the tags by year, and by country and year, with aggregate
+    queries.
+
+    Also returns the distinct tags of each user (or post, with level
+    "post") for the co-occurrence matrix. If year is given, only the
+    posts created in that year are counted.
+    """
+    query = POST_TAGS_QUERY
+    params = ()
+    if year is not None:
+        query += " WHERE p.CreationDate >= ? AND p.CreationDate < ?"
+        params = (str(year), str(year + 1))
+
+    tag_year = pd.read_sql_query(
+        "SELECT tag, year, COUNT(*) AS count FROM (" + query +
+        ") GROUP BY tag, year", con, ["tag", "year"], params=params)["count"]
+    country_tag_year = pd.read_sql_query(
+        "SELECT country, tag, year, COUNT(*) AS count FROM (" + query +
+        ") WHERE country IS NOT NULL GROUP BY country, tag, year",
+        con, ["country", "tag", "year"], params=params)["count"]
+
+    # Only the distinct tags of each user (or post) are needed for the
+    # co-occurrence matrix
+    if level == "post":
+        unit_tags = pd.read_sql_query(
+            "SELECT post, year, country, tag FROM (" + query + ")",
+            con, "post", params=params)
+    else:
+        unit_tags = pd.read_sql_query(
+            "SELECT DISTINCT user, year, country, tag FROM (" + query +
+            ") WHERE user IS NOT NULL", con, params=params)
+
+    return tag_year, country_tag_year, unit_tags
 
-    # Count and relative frequency of tags by year (line chart)
-    summary_table(posts, group_by=["tag", "year"], freq=True,
-                  freq_by="year").to_csv("tag_year.csv")
 
-    # Count and relative frequency of tags by country (bar chart / choropleth)
-    country_tag = summary_table(posts, group_by=["country", "tag"],
-                                freq=True, freq_by="country")
+def add_counts(total, counts):
+    if total is None:
+        return counts
+    return total.add(counts, fill_value=0)
 
-    # Worldwide count and relative frequency of tags (bar char)
-    worldwide_tag = summary_table(posts, group_by=["tag"], freq=True)
+
+def add_matrices(total, matrices):
+    if total is None:
+        return matrices
+    for key, matrix in matrices.items():
+        total[key] = add_counts(total.get(key), matrix)
+    return total
+
+
+def integer_counts(df):
+    # Adding partial counts with missing values converts them to float
+    if pd.notnull(df).all().all():
+        return df.astype(np.int64)
+    return df
+
+
+def count_table(counts, freq=False, freq_by=None):
+    # Grouping by categorical columns also counts combinations of
+    # categories that were never observed
+    counts = counts[counts > 0]
+    df = pd.DataFrame({"count": counts.astype(np.int64)}).sort_index()
+
+    if freq:
+        add_frequency(df, freq_by)
+
+    return df
+
+
+def append_worldwide(country_tag, worldwide_tag):
+    worldwide_tag = worldwide_tag.copy()
     worldwide_tag["country"] = "XXX"
     worldwide_tag.set_index("country", append=True, inplace=True)
     worldwide_tag = worldwide_tag.reorder_levels(["country", "tag"])
 
-    country_tag.append(worldwide_tag).to_csv("country_tag.csv")
-
-    # Tag co-occurrence matrix (chord diagram)
-    tag_matrix(posts).to_json("tag_matrix.json")
+    return country_tag.append(worldwide_tag)
 
 
 def summary_table(posts, group_by, freq=False, freq_by=None):
-    df = posts.reset_index().groupby(group_by).count()[["index"]]
-    df.rename(columns={"index": "count"}, inplace=True)
+    return count_table(posts.groupby(group_by).size(), freq, freq_by)
 
-    if freq:
-        if freq_by is None:
-            by = df
-        else:
-            by = df.groupby(level=freq_by)
-        df["freq"] = df / by.sum()
 
-    return df
+def add_frequency(df, freq_by=None):
+    if freq_by is None:
+        by = df
+    else:
+        by = df.groupby(level=freq_by)
+    df["freq"] = df / by.sum()
 
 
 def country_table(users):
@@ -90,22 +607,115 @@ def country_table(users):
 
     countries.rename(columns={"user": "users"}, inplace=True)
 
+    return add_country_names(countries)
+
+
+def add_country_names(countries):
     countries["name"] = countries.index.map(lambda country:
         pycountry.countries.get(alpha_3=country).name)
 
     return countries
 
 
-def tag_matrix(posts):
-    posts = posts[["tag", "user"]].reset_index()
-    user_tag = posts.groupby(["tag", "user"]).count()
-    user_tag = user_tag.reset_index().set_index("user")[["tag"]]
+def tag_matrix(posts, level="user"):
+    """Count the users that have each pair of tags.
+
+    The counts are computed from a sparse user by tag incidence matrix A
+    as A'A, so each user is counted once per pair of tags. With level
+    "post", posts are counted instead of users.
+    """
+    if level == "post":
+        units = posts.index.values
+    else:
+        posts = posts[posts["user"] >= 0]
+        units = posts["user"].values
+
+    unit_codes, unit_values = pd.factorize(units)
+    tag_codes, tags = tag_codes_and_names(posts["tag"])
+
+    incidence = sparse.csr_matrix(
+        (np.ones(len(tag_codes), dtype=np.int64), (unit_codes, tag_codes)),
+        shape=(len(unit_values), len(tags)))
+    incidence.data[:] = 1
+
+    counts = incidence.T.dot(incidence).toarray()
+
+    # Keep only the tags that were observed
+    observed = np.diag(counts) > 0
+    tags = pd.Index(tags[observed])
+    counts = pd.DataFrame(counts[observed][:, observed],
+                          tags.rename("tag1"), tags.rename("tag2"))
+
+    # Pairs of tags that never occur together are missing values
+    return integer_counts(counts.where(counts > 0))
+
 
-    tag_pairs = user_tag.join(user_tag, lsuffix="1", rsuffix="2")
-    tag_pairs = tag_pairs.reset_index().groupby(["tag1", "tag2"]).count()
-    tag_pairs = tag_pairs.rename(columns={"user": "count"}).reset_index()
+def tag_codes_and_names(tags):
+    # Categorical tags are already coded, in sorted order
+    if tags.dtype.name == "category":
+        return tags.cat.codes.values, np.asarray(tags.cat.categories)
+    return pd.factorize(tags, sort=True)
 
-    return tag_pairs.pivot("tag1", "tag2", "count")
+
+def tag_matrices(posts, level="user", by_year=False, slices=()):
+    matrices = {"all": tag_matrix(posts, level)}
+
+    if by_year:
+        for year, year_posts in posts.groupby("year"):
+            matrices[year] = tag_matrix(year_posts, level)
+
+    for column in slices:
+        matrices["by_" + column] = tag_slices(posts, column, level)
+
+    return matrices
+
+
+def is_sliced(key):
+    # Keys of the counts created by tag_slices() in tag_matrices()
+    return isinstance(key, str) and key.startswith("by_")
+
+
+def tag_slices(posts, column, level="user"):
+    """Count the users that have each pair of tags, separately for each
+    value of a column, such as the year or the country.
+
+    All slices are counted with a single sparse product: each user is
+    split into one unit per slice, and the incidence matrix has a column
+    per slice and tag, so the product is block diagonal, with the matrix
+    of each slice in a block. Returns the non-zero counts of each pair
+    (tag1, tag2), with tag1 <= tag2, indexed by slice and pair, so that
+    partial counts can be added with add_counts(). With level "post",
+    posts are counted instead of users.
+    """
+    posts = posts[pd.notnull(posts[column])]
+    if level == "post":
+        units = posts.index.values
+    else:
+        posts = posts[posts["user"] >= 0]
+        units = posts["user"].values
+
+    slice_codes, slice_values = pd.factorize(np.asarray(posts[column]),
+                                             sort=True)
+    tag_codes, tags = tag_codes_and_names(posts["tag"])
+    unit_codes, unit_values = pd.factorize(
+        units.astype(np.int64) * len(slice_values) + slice_codes)
+
+    incidence = sparse.csr_matrix(
+        (np.ones(len(tag_codes), dtype=np.int64),
+         (unit_codes, slice_codes * len(tags) + tag_codes)),
+        shape=(len(unit_values), len(slice_values) * len(tags)))
+    incidence.data[:] = 1
+
+    counts = incidence.T.dot(incidence).tocoo()
+    tag1 = counts.row % len(tags)
+    tag2 = counts.col % len(tags)
+    upper = tag1 <= tag2
+
+    index = pd.MultiIndex.from_arrays(
+        [slice_values[counts.row[upper] // len(tags)],
+         tags[tag1[upper]], tags[tag2[upper]]],
+        names=[column, "tag1", "tag2"])
+    return pd.Series(counts.data[upper], index).sort_index()
 
 
 def merge_users_countries(users, locations):
@@ -115,52 +725,315 @@ def merge_users_countries(users, locations):
     users.rename(columns={"Id": "user", "Country": "country"}, inplace=True)
     users.set_index("user", inplace=True)
 
-    return users[pd.notnull(users["country"])]
+    users = users[pd.notnull(users["country"])].copy()
+    users.index = users.index.astype(np.int32)
+    users["country"] = users["country"].astype("category")
 
+    return users
 
-def merge_posts_countries(posts, users):
-    posts = posts.merge(users, "left", left_on="OwnerUserId",
-                        right_index=True)
 
-    # Use None instead of NaN for missing countries
-    posts.loc[:, "country"] = posts["country"].where(
-                                  pd.notnull(posts["country"]), None)
+def merge_posts_countries(posts, users):
+    # Posts of users without a country get a missing category
+    posts["country"] = users["country"].reindex(posts["OwnerUserId"]).values
 
     return posts
 
 
-def explode_tags(posts):
-    posts = posts.copy()
+def read_posts_parquet(directory):
+    """Read the posts from the Parquet data set written by the import step.
+
+    Only the columns needed are read, and the files are memory mapped.
+    """
+    import pyarrow.parquet as pq
+
+    columns = ["Id", "PostTypeId", "ParentId", "OwnerUserId", "Tags", "year"]
+    posts = pq.read_table(directory, columns=columns,
+                          memory_map=True).to_pandas()
+
+    # The year is stored as the partition key, and may be read back as a
+    # category of strings
+    year = posts["year"]
+    if year.dtype.name == "category":
+        years = np.asarray(year.cat.categories).astype(np.int16)
+        posts["year"] = years[year.cat.codes.values]
+
+    return posts.set_index("Id")
 
+
+def compact_posts(posts):
+    posts.index = posts.index.astype(np.int32)
+    posts["PostTypeId"] = posts["PostTypeId"].astype(np.int8)
+    for column in ("ParentId", "OwnerUserId"):
+        posts[column] = posts[column].fillna(NO_ID).astype(np.int32)
+    posts["year"] = posts["year"].astype(np.int16)
+
+    return posts
+
+
+def explode_tags(posts, selected_tags):
     # Tags are stored as a string in the format "<tag1><tag2><tag3>".
-    # We want to convert this string to a list of strings, where each
-    # element of the list is a tag. First, we remove the first ("<")
-    # and last (">") characters of the string, and then we split it on
-    # the delimiters in the middle ("><").
-    posts["Tags"] = posts["Tags"].str[1:-1].str.split("><")
-
-    # In the data dump, only questions have tags. Since we also want
-    # to consider answers, we set the tags of the answers to the same
-    # value as their parent question.
-    answers_tags = posts[posts.PostTypeId == 2][["ParentId"]]
-    answers_tags = answers_tags.join(posts[["Tags"]], on="ParentId")
-    posts.update(answers_tags[["Tags"]])
+    # They are parsed once, into a TagIndex of the posts that have them.
+    tagged = posts[pd.notnull(posts["Tags"])]
+    tag_index = TagIndex.from_chunks([(tagged.index.values, tagged["Tags"])],
+                                     selected_tags)
 
     # Keep only the columns we are going to use
-    posts = posts[["year", "Tags", "OwnerUserId", "country"]]
-    posts.rename(columns={"OwnerUserId": "user"}, inplace=True)
-
-    # Keep only posts that have at least one tag
-    posts = posts[~pd.isnull(posts["Tags"])]
+    posts = posts[["PostTypeId", "ParentId", "year", "OwnerUserId",
+                   "country"]]
+    posts = posts.rename(columns={"OwnerUserId": "user"})
 
-    # Finally, explode the posts table, so that each post appears
-    # n times, where n is the number of tags on that post. Each
+    # Then the posts table is exploded, so that each post appears n
+    # times, where n is the number of tags on that post. Each
     # observation of a post will have a single tag.
-    new_index = np.hstack([[post_id] * len(tag) for post_id, tag
-                           in posts["Tags"].iteritems()])
-    posts_tags = pd.DataFrame({"tag": np.hstack(posts["Tags"])}, new_index)
+    return tag_index.explode(posts, posts["PostTypeId"].values,
+                             posts["ParentId"].values)
+
+
+class TagIndex:
+    """The clean tags of the posts that have them, looked up by post id.
+
+    In the data dump, only questions have tags. Since we also want to
+    consider answers, they are given the tags of their parent question,
+    which is looked up by id with a binary search (searchsorted) in a
+    sorted array of the ids of the posts with tags. The tags of the post
+    at position i are codes[offsets[i]:offsets[i + 1]], the positions of
+    their clean names in categories (as in a CSR matrix). Only this
+    index, and not all the posts, needs to be in memory to tag the
+    answers in a chunk of posts.
+    """
+
+    def __init__(self, ids, offsets, codes, categories):
+        self.ids = ids
+        self.offsets = offsets
+        self.codes = codes
+        self.categories = categories
+
+    @classmethod
+    def from_chunks(cls, chunks, selected_tags):
+        """Create an index from (ids, tags) chunks of the posts with tags,
+        with the tags in the format "<tag1><tag2><tag3>"."""
+        categories = tag_categories(selected_tags)
+        code_type = np.int16 if len(categories) < 2**15 else np.int32
+
+        ids = [np.empty(0, np.int32)]
+        lengths = [np.empty(0, np.int64)]
+        codes = [np.empty(0, code_type)]
+        for chunk_ids, tags in chunks:
+            # First, we remove the first ("<") and last (">") characters
+            # of the string, and then we split it on the delimiters in
+            # the middle ("><").
+            tags = tags.str[1:-1].str.split("><").values
+            ids.append(np.asarray(chunk_ids, np.int32))
+            lengths.append(np.fromiter(map(len, tags), np.int64, len(tags)))
+            codes.append(clean_tag_codes(list(chain.from_iterable(tags)),
+                                         selected_tags, categories)
+                         .astype(code_type))
+
+        ids, lengths, codes = (np.concatenate(x)
+                               for x in (ids, lengths, codes))
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+        # Posts are usually read in id order already
+        if (np.diff(ids) < 0).any():
+            order = np.argsort(ids, kind="stable")
+            _, positions = csr_positions(offsets[order], lengths[order])
+            ids, codes = ids[order], codes[positions]
+            offsets = np.concatenate([[0], np.cumsum(lengths[order])])
+
+        return cls(ids, offsets, codes, categories)
+
+    def find(self, ids):
+        """Return the position of each id in the index, or -1."""
+        ids = np.asarray(ids)
+        if len(self.ids) == 0:
+            return np.full(len(ids), -1)
+
+        positions = np.searchsorted(self.ids, ids)
+        positions[positions == len(self.ids)] = 0
+        return np.where(self.ids[positions] == ids, positions, -1)
+
+    def explode(self, posts, post_types, parent_ids):
+        """Return a row for each tag of each post, with its clean name in
+        the tag column and the year, user and country of the post.
+
+        Answers whose parent question has tags are given those tags, and
+        other posts their own. Posts without tags are left out.
+        """
+        positions = self.find(posts.index.values)
+        parents = self.find(np.where(post_types == 2, parent_ids, NO_ID))
+        positions = np.where(parents >= 0, parents, positions)
+
+        rows = np.flatnonzero(positions >= 0)
+        starts = self.offsets[positions[rows]]
+        lengths = self.offsets[positions[rows] + 1] - starts
+        tag_rows, tag_positions = csr_positions(starts, lengths)
+        rows = rows[tag_rows]
+
+        posts_tags = pd.DataFrame(
+            {"tag": pd.Categorical.from_codes(self.codes[tag_positions],
+                                              self.categories)},
+            posts.index.values[rows])
+        for column in ("year", "user", "country"):
+            posts_tags[column] = posts[column].values.take(rows)
+
+        return posts_tags
+
+
+def csr_positions(starts, lengths):
+    """Return the positions of the elements of a set of CSR rows, given
+    their starts and lengths, and the row of each element."""
+    rows = np.repeat(np.arange(len(starts)), lengths)
+    ends = np.cumsum(lengths)
+    positions = (np.arange(ends[-1] if len(ends) else 0) +
+                 np.repeat(starts - (ends - lengths), lengths))
+    return rows, positions
+
+
+def tag_categories(selected_tags):
+    # The clean names are stored as a categorical, with the categories in
+    # sorted order
+    return pd.Index(sorted(set(selected_tags["newname"]) | {"Other"}))
+
+
+def clean_tag_codes(tags, selected_tags, categories):
+    # Clean up tag names. Each distinct tag is looked up only once, and
+    # tags that were not selected are renamed to "Other".
+    codes, uniques = pd.factorize(np.asarray(tags, dtype=object))
+    newnames = selected_tags["newname"].reindex(uniques)
+    newnames = newnames.where(pd.notnull(newnames), "Other")
+
+    return categories.get_indexer(newnames)[codes]
+
+
+def compact_datasets(datasets, tags, top_k=None):
+    """Encode the data sets as dense arrays of integer counts.
+
+    Tags and countries are identified by their position in tags.json and
+    countries.json, with "Other" after the last tag. The frequencies are
+    left out, as they can be derived from the counts. The co-occurrence
+    matrices by year or country are encoded with sparse_slices().
+    """
+    tags = list(tags) + ["Other"]
+
+    country_tag = datasets["country_tag"]["count"].unstack("tag")
+    tag_year = datasets["tag_year"]["count"].unstack("year").reindex(tags)
+
+    compact = {
+        "country_tag": {
+            "count": dense_counts(country_tag.reindex(
+                index=datasets["countries"].index, columns=tags)),
+            "worldwide": dense_counts(country_tag.reindex(
+                index=["XXX"], columns=tags))[0],
+        },
+        "tag_year": {
+            "years": [int(year) for year in tag_year.columns],
+            "count": dense_counts(tag_year),
+        },
+    }
+
+    for year, matrix in datasets["tag_matrices"].items():
+        if is_sliced(year):
+            compact["tag_matrix_" + year] = sparse_slices(matrix, tags, top_k)
+            continue
+
+        name = "tag_matrix" if year == "all" else "tag_matrix_%s" % year
+        compact[name] = dense_counts(matrix.reindex(index=tags,
+                                                    columns=tags))
+
+    return compact
+
+
+def sparse_slices(counts, tags, top_k=None):
+    """Encode the co-occurrence counts of each slice as a sparse matrix.
+
+    The counts of each tag (the diagonal of the matrix) are kept in
+    "totals", and only the top_k pairs of tags with the highest counts
+    in "edges", as a flat list of [tag1, tag2, count] triples.
+    """
+    column = counts.index.names[0]
+    positions = pd.Index(tags)
+    compact = {"slices": [], "top_k": top_k, "matrices": []}
+
+    for value, slice_counts in counts.groupby(level=column):
+        tag1 = positions.get_indexer(
+            slice_counts.index.get_level_values("tag1"))
+        tag2 = positions.get_indexer(
+            slice_counts.index.get_level_values("tag2"))
+        values = slice_counts.values.astype(np.int64)
+
+        totals = np.zeros(len(tags), np.int64)
+        diagonal = tag1 == tag2
+        totals[tag1[diagonal]] = values[diagonal]
+
+        # Highest counts first, and ties in the order of the tags
+        tag1, tag2, values = (x[~diagonal] for x in (tag1, tag2, values))
+        order = np.lexsort((tag2, tag1, -values))[:top_k]
+        edges = np.column_stack([tag1[order], tag2[order], values[order]])
+
+        compact["slices"].append(np.asarray(value).tolist())
+        compact["matrices"].append({"totals": totals.tolist(),
+                                    "edges": edges.ravel().tolist()})
+
+    return compact
+
+
+def dense_counts(df):
+    # Missing counts are zero
+    return df.fillna(0).astype(np.int64).values.tolist()
+
+
+def write_compact(name, data):
+    # Also write compressed copies, to be served as they are. The
+    # timestamp is left out of the gzip header so that the output only
+    # changes when the data does.
+    text = json.dumps(data, separators=(",", ":")).encode()
+    filename = name + ".min.json"
+
+    with open(filename, "wb") as f:
+        f.write(text)
+    with gzip.GzipFile(filename + ".gz", "wb", 9, mtime=0) as f:
+        f.write(text)
+    if brotli is not None:
+        with open(filename + ".br", "wb") as f:
+            f.write(brotli.compress(text))
+
+
+def count_cube(datasets, tags):
+    """Arrange the counts by country, tag and year in a dense array.
+
+    Tags are in the order of tags.json, followed by "Other", and the
+    worldwide counts are stored as the last country, "XXX".
+    """
+    tag_year = datasets["tag_year"]["count"]
+    index = {
+        "countries": list(datasets["countries"].index) + ["XXX"],
+        "tags": list(tags) + ["Other"],
+        "years": sorted(int(year) for year
+                        in tag_year.index.get_level_values("year").unique()),
+    }
+    levels = {"country": "countries", "tag": "tags", "year": "years"}
+
+    cube = np.zeros([len(labels) for labels in index.values()], np.int32)
+    worldwide = pd.concat({"XXX": tag_year}, names=["country"])
+    for counts in (datasets["country_tag_year"], worldwide):
+        counts = counts[counts > 0]
+        positions = tuple(
+            pd.Index(index[levels[level]]).get_indexer(
+                np.asarray(counts.index.get_level_values(level)))
+            for level in ("country", "tag", "year"))
+        cube[positions] = counts.values
+
+    return cube, index
+
 
-    return posts_tags.join(posts[["year", "user", "country"]])
+def write_cube(name, cube, index):
+    # The array is replaced only after it has been completely written,
+    # as a running server reloads it when it changes
+    with open(name + ".json", "w") as f:
+        json.dump(index, f)
+    with open(name + ".npy.tmp", "wb") as f:
+        np.save(f, cube)
+    os.replace(name + ".npy.tmp", name + ".npy")
 
 
 def get_selected_tags(config):
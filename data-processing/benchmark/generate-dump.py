@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+"""Generate a synthetic Stack Overflow dump (Users.xml and Posts.xml).
+
+Tags are drawn from selected-tags.csv, weighted by their count, and
+locations from the gazetteer, so that every step of the pipeline can be
+run on a dump of any size.
+"""
+
+import argparse
+import csv
+import datetime
+import os
+import random
+from xml.sax.saxutils import escape
+
+import pycountry
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+FIRST_DATE = datetime.datetime(2008, 8, 1)
+LAST_DATE = datetime.datetime(2016, 12, 1)
+
+# Probability of a question having 1, 2, 3, 4 or 5 tags
+TAG_COUNT_WEIGHTS = (0.12, 0.25, 0.30, 0.20, 0.13)
+
+# Locations that the geocoders can't resolve
+JUNK_LOCATIONS = ("Earth", "127.0.0.1", "Somewhere", "Behind you", "Mars")
+
+LOREM = ("<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed "
+         "do eiusmod tempor incididunt ut labore et dolore magna aliqua.</p>"
+         "\n<pre><code>for (int i = 0; i < n; i++) { x &= y; }</code></pre>"
+         "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--posts", type=int, default=100000,
+                        help="number of posts (default: %(default)s)")
+    parser.add_argument("--users", type=int,
+                        help="number of users (default: posts / 10)")
+    parser.add_argument("--answers-per-question", type=float, default=1.5,
+                        help="average number of answers per question "
+                             "(default: %(default)s)")
+    parser.add_argument("--located", type=float, default=0.4,
+                        help="fraction of users with a location "
+                             "(default: %(default)s)")
+    parser.add_argument("--tags", default="data/selected-tags.csv",
+                        help="tags file (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="data/raw",
+                        help="output directory (default: %(default)s)")
+    args = parser.parse_args()
+
+    generate_dump(args.output, args.posts, args.users or args.posts // 10,
+                  args.tags, args.answers_per_question, args.located,
+                  args.seed)
+
+
+def generate_dump(directory, post_count, user_count, tags_file,
+                  answers_per_question=1.5, located=0.4, seed=1):
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    write_rows(os.path.join(directory, "Users.xml"), "users",
+               generate_users(rng, user_count, located))
+    write_rows(os.path.join(directory, "Posts.xml"), "posts",
+               generate_posts(rng, post_count, user_count,
+                              read_tags(tags_file), answers_per_question))
+
+
+def read_tags(filename):
+    with open(filename, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+
+    # Without counts, all tags are equally likely
+    tags = [row["tag"] for row in rows]
+    weights = [int(row.get("count") or 1) for row in rows]
+
+    return tags, weights
+
+
+def read_gazetteer():
+    with open(os.path.join(HERE, "..", "gazetteer.csv"), newline="",
+              encoding="utf-8") as f:
+        return [(row["name"],
+                 pycountry.countries.get(alpha_3=row["country"]).name)
+                for row in csv.DictReader(f)]
+
+
+def generate_users(rng, count, located):
+    places = read_gazetteer()
+
+    for user_id in range(1, count + 1):
+        row = [("Id", user_id),
+               ("Reputation", int(rng.paretovariate(0.8))),
+               ("CreationDate", random_date(rng).isoformat(
+                   timespec="milliseconds")),
+               ("DisplayName", "user%d" % user_id)]
+
+        if rng.random() < located:
+            row.append(("Location", random_location(rng, places)))
+
+        row.append(("AboutMe", LOREM[:rng.randrange(len(LOREM))]))
+        yield row
+
+
+def random_location(rng, places):
+    if rng.random() < 0.05:
+        return rng.choice(JUNK_LOCATIONS)
+
+    city, country = rng.choice(places)
+    style = rng.random()
+    if style < 0.4:
+        return city
+    elif style < 0.8:
+        return "%s, %s" % (city, country)
+    else:
+        return city.lower() + "  "
+
+
+def generate_posts(rng, count, user_count, tags, answers_per_question):
+    tag_names, tag_weights = tags
+    cum_tag_weights = cumulative(tag_weights)
+
+    # A few users write most of the posts
+    cum_user_weights = cumulative(1 / (i + 1) for i in range(user_count))
+
+    p_answer = answers_per_question / (1 + answers_per_question)
+    step = (LAST_DATE - FIRST_DATE) / count
+    questions = []
+
+    for post_id in range(1, count + 1):
+        row = [("Id", post_id)]
+
+        # Answers are given to recent questions
+        if questions and rng.random() < p_answer:
+            row += [("PostTypeId", 2),
+                    ("ParentId", rng.choice(questions[-1000:]))]
+        else:
+            questions.append(post_id)
+            row.append(("PostTypeId", 1))
+
+        row += [("CreationDate", (FIRST_DATE + step * post_id).isoformat(
+                     timespec="milliseconds")),
+                ("Score", int(rng.gauss(2, 5))),
+                ("Body", LOREM * rng.randint(1, 6))]
+
+        if rng.random() < 0.97:
+            user = rng.choices(range(1, user_count + 1),
+                               cum_weights=cum_user_weights)[0]
+            row.append(("OwnerUserId", user))
+
+        if row[1][1] == 1:
+            tag_count = rng.choices(range(1, 6), TAG_COUNT_WEIGHTS)[0]
+            post_tags = dict.fromkeys(rng.choices(
+                tag_names, cum_weights=cum_tag_weights, k=tag_count))
+            row += [("Title", "Question %d" % post_id),
+                    ("Tags", "".join("<%s>" % tag for tag in post_tags))]
+
+        yield row
+
+
+def random_date(rng):
+    return FIRST_DATE + (LAST_DATE - FIRST_DATE) * rng.random()
+
+
+def cumulative(weights):
+    total = 0
+    result = []
+    for weight in weights:
+        total += weight
+        result.append(total)
+    return result
+
+
+def write_rows(filename, root, rows):
+    # Same layout as the data dump, with one row per line
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<%s>\n' % root)
+        for row in rows:
+            attributes = " ".join(
+                '%s="%s"' % (name, escape(str(value),
+                                          {'"': "&quot;", "\n": "&#xA;"}))
+                for name, value in row)
+            f.write("  <row %s />\n" % attributes)
+        f.write("</%s>\n" % root)
+
+
+if __name__ == "__main__":
+    main()
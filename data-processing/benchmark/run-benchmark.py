@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+"""Run the pipeline on a synthetic dump and record its performance.
+
+Each step runs in a child process, in a working directory with its own
+copy of stacktrends.ini, and the remote geocoders are replaced by a local
+stub server. The wall time, CPU time and peak RSS of each step are
+written to a JSON file, and compared with a previous results file if one
+is given.
+"""
+
+import argparse
+import configparser
+import csv
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import importlib.util
+import json
+import os
+import platform
+import shutil
+from socketserver import ThreadingMixIn
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import pycountry
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PIPELINE = os.path.dirname(HERE)
+
+ENGINES = ("memory", "chunked", "sql", "partitioned")
+
+# Metrics compared between runs
+METRICS = ("wall_time", "cpu_time", "peak_rss_mib")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--posts", type=int, default=100000,
+                        help="number of posts (default: %(default)s)")
+    parser.add_argument("--users", type=int,
+                        help="number of users (default: posts / 10)")
+    parser.add_argument("--engines", default=",".join(ENGINES),
+                        help="data set engines to run "
+                             "(default: %(default)s)")
+    parser.add_argument("--stub-latency", type=float, default=0.05,
+                        help="response time of the stub geocoders, in "
+                             "seconds (default: %(default)s)")
+    parser.add_argument("--directory",
+                        help="working directory, kept after the run "
+                             "(default: a temporary directory)")
+    parser.add_argument("--output",
+                        help="results file (default: "
+                             "benchmark/results/<date>.json)")
+    parser.add_argument("--compare", metavar="RESULTS",
+                        help="results file of a previous run to compare to")
+    parser.add_argument("--threshold", type=float, default=1.1,
+                        help="ratio to the previous run above which a "
+                             "metric is a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.directory is None:
+        with tempfile.TemporaryDirectory() as directory:
+            results = run_benchmark(directory, args)
+    else:
+        results = run_benchmark(args.directory, args)
+
+    output = args.output or os.path.join(
+        HERE, "results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to %s" % output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if compare_results(previous, results, args.threshold):
+            sys.exit(1)
+
+
+def run_benchmark(directory, args):
+    for subdirectory in ("data", "logs"):
+        os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+    tags_file = os.path.join(PIPELINE, "data", "selected-tags.csv")
+    shutil.copy(tags_file, os.path.join(directory, "data"))
+
+    user_count = args.users or args.posts // 10
+    print("Generating a dump with %d posts and %d users" %
+          (args.posts, user_count))
+    generator = load_script("generate-dump.py")
+    generator.generate_dump(os.path.join(directory, "data", "raw"),
+                            args.posts, user_count, tags_file)
+
+    server = start_stub_server(args.stub_latency)
+    config = benchmark_config("http://127.0.0.1:%d" % server.server_port)
+
+    results = {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "posts": args.posts,
+        "users": user_count,
+        "steps": {},
+    }
+    steps = results["steps"]
+
+    steps["import"] = run_step(directory, config, "import",
+                               "1_import-so-data.py")
+    steps["geocode"] = run_step(directory, config, "geocode",
+                                "2_locations.py")
+    steps["geocode"]["requests"] = server.request_count
+
+    for engine in args.engines.split(","):
+        config["Datasets"]["engine"] = engine
+        steps["datasets-" + engine] = run_step(
+            directory, config, "datasets-" + engine, "3_create-datasets.py")
+
+    server.shutdown()
+    return results
+
+
+def load_script(filename):
+    # The scripts are not importable by name
+    spec = importlib.util.spec_from_file_location(
+        os.path.splitext(filename)[0].replace("-", "_"),
+        os.path.join(HERE, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def benchmark_config(stub_url):
+    config = configparser.ConfigParser()
+    config.read(os.path.join(PIPELINE, "stacktrends.ini"))
+
+    config["Geocoding"]["geocoders"] = "ArcGIS, Bing, Nominatim"
+    config["Geocoding"]["resume"] = "no"
+    config["GazetteerCountryCoder"]["filename"] = os.path.join(
+        PIPELINE, "gazetteer.csv")
+    config["Datasets"]["partials_directory"] = ""
+
+    # The stub server has no usage limits
+    for section, path in (("ArcGISCountryCoder", "/arcgis"),
+                          ("BingCountryCoder", "/bing"),
+                          ("NominatimCountryCoder", "/nominatim")):
+        config[section]["api"] = stub_url + path
+        config[section]["rate_limit"] = "0"
+    config["BingCountryCoder"]["api_key"] = "benchmark"
+
+    return config
+
+
+def run_step(directory, config, name, script):
+    """Run a script of the pipeline and measure its resource usage.
+
+    The peak RSS is that of the largest process, including the worker
+    processes started by the script. The report written by the script
+    is added to the results, with the measurements of each stage.
+    """
+    print("Running %s" % name)
+    reports = os.path.join(directory, "reports", name)
+    config["Instrumentation"]["directory"] = reports
+    with open(os.path.join(directory, "stacktrends.ini"), "w") as f:
+        config.write(f)
+
+    with open(os.path.join(directory, "logs", name + ".log"), "w") as log:
+        start_time = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(PIPELINE, script)],
+            cwd=directory, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_time = time.perf_counter() - start_time
+
+    if status != 0:
+        raise RuntimeError("%s failed, see %s" % (
+            name, os.path.join(directory, "logs", name + ".log")))
+
+    # ru_maxrss is in KiB on Linux
+    results = {
+        "wall_time": round(wall_time, 3),
+        "cpu_time": round(usage.ru_utime + usage.ru_stime, 3),
+        "peak_rss_mib": round(usage.ru_maxrss / 1024, 1),
+    }
+
+    for filename in os.listdir(reports):
+        if filename.endswith(".json"):
+            with open(os.path.join(reports, filename)) as f:
+                report = json.load(f)
+            results["stages"] = report["stages"]
+            if "geocoders" in report:
+                results["geocoders"] = report["geocoders"]
+
+    return results
+
+
+def compare_results(previous, current, threshold):
+    """Print the ratio of each metric to the previous run.
+
+    Returns True if any metric regressed by more than the threshold.
+    """
+    regression = False
+    print("%-22s %-12s %10s %10s %7s" %
+          ("step", "metric", "previous", "current", "ratio"))
+
+    for step, metrics in current["steps"].items():
+        if step not in previous["steps"]:
+            continue
+        for metric in METRICS:
+            before = previous["steps"][step][metric]
+            after = metrics[metric]
+            ratio = after / before if before else float("inf")
+            flag = ""
+            if ratio > threshold:
+                flag = " REGRESSION"
+                regression = True
+            print("%-22s %-12s %10.3f %10.3f %7.2f%s" %
+                  (step, metric, before, after, ratio, flag))
+
+    return regression
+
+
+#
+# Stub geocoding server
+#
+
+def start_stub_server(latency):
+    places = {}
+    with open(os.path.join(PIPELINE, "gazetteer.csv"), newline="",
+              encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            places[row["name"].lower()] = row["country"]
+
+    class StubHandler(GeocoderStubHandler):
+        pass
+
+    StubHandler.places = places
+    StubHandler.latency = latency
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.request_count = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class GeocoderStubHandler(BaseHTTPRequestHandler):
+    """Answer ArcGIS, Bing and Nominatim queries from the gazetteer."""
+
+    places = {}
+    latency = 0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        with self.server.lock:
+            self.server.request_count += 1
+        time.sleep(self.latency)
+
+        if url.path == "/arcgis":
+            country = self.lookup(query["singleLine"][0])
+            body = {"candidates": [{
+                "address": country.name,
+                "location": {"x": 0, "y": 0},
+                "attributes": {"Country": country.alpha_3},
+            }] if country else []}
+        elif url.path == "/bing":
+            country = self.lookup(query["query"][0])
+            body = {"statusCode": 200, "resourceSets": [{"resources": [{
+                "address": {"formattedAddress": country.name,
+                            "countryRegionIso2": country.alpha_2},
+                "point": {"coordinates": [0, 0]},
+            }] if country else []}]}
+        elif url.path == "/nominatim":
+            country = self.lookup(query["q"][0])
+            body = [{
+                "lat": "0", "lon": "0", "display_name": country.name,
+                "address": {"country_code": country.alpha_2.lower()},
+            }] if country else []
+        else:
+            self.send_error(404)
+            return
+
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def lookup(self, location):
+        name = location.split(",")[0].strip().lower()
+        if name in self.places:
+            return pycountry.countries.get(alpha_3=self.places[name])
+        return None
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    main()
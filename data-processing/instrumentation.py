@@ -0,0 +1,163 @@
+"""Measure the stages of the pipeline scripts and write run reports.
+
+A script calls start() once, wraps each stage in a stage() block and
+calls finish() at the end, which writes a JSON report with the wall
+time, CPU time, rows processed and peak RSS of each stage. With
+profile=yes in the [Instrumentation] section, each stage is also run
+under cProfile and its statistics are dumped next to the report.
+"""
+
+import cProfile
+from contextlib import contextmanager
+import json
+import os
+import resource
+import time
+
+_report = None
+_depth = 0
+
+
+class Report:
+    def __init__(self, script, directory=None, profile=False):
+        self.script = script
+        self.directory = directory
+        self.profile = profile
+        self.started = time.strftime("%Y%m%d-%H%M%S")
+        self.start_wall = time.perf_counter()
+        self.start_cpu = cpu_time()
+        self.stages = []
+        self.metrics = {}
+
+    def filename(self, suffix):
+        return os.path.join(self.directory, "%s-%s%s" % (
+            self.script, self.started, suffix))
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+
+
+def start(script, config):
+    global _report
+    section = config["Instrumentation"]
+    directory = section.get("directory") or None
+    if directory is not None:
+        # Scripts may change the working directory
+        directory = os.path.abspath(directory)
+        os.makedirs(directory, exist_ok=True)
+    _report = Report(script, directory, section.getboolean("profile", False))
+    return _report
+
+
+def record(name, value):
+    """Add a metric that is not measured by stage() to the report."""
+    if _report is not None:
+        _report.metrics[name] = value
+
+
+@contextmanager
+def stage(name):
+    """Measure the code run in the block as a stage of the script.
+
+    The number of rows processed can be set in the rows attribute of the
+    object returned. The peak RSS of nested stages includes the memory
+    used by the enclosing stage before they started.
+    """
+    global _depth
+    stage = Stage(name)
+
+    if _depth == 0:
+        reset_peak_rss()
+    _depth += 1
+
+    profiler = None
+    if _report is not None and _report.profile:
+        profiler = cProfile.Profile()
+
+    start_wall = time.perf_counter()
+    start_cpu = cpu_time()
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        yield stage
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        _depth -= 1
+
+        metrics = {
+            "name": name,
+            "wall_time": round(time.perf_counter() - start_wall, 3),
+            "cpu_time": round(cpu_time() - start_cpu, 3),
+            "rows": stage.rows,
+            "peak_rss_mib": round(peak_rss() / 2**20, 1),
+        }
+        print("%s: %.1f s, %.1f s CPU, %s rows, %.0f MiB peak RSS" % (
+            name, metrics["wall_time"], metrics["cpu_time"],
+            "-" if stage.rows is None else stage.rows,
+            metrics["peak_rss_mib"]))
+
+        if _report is not None:
+            _report.stages.append(metrics)
+            if profiler is not None and _report.directory is not None:
+                profiler.dump_stats(_report.filename("-%s.prof" % name))
+
+
+def finish():
+    """Write the report of the script, if a directory was configured."""
+    global _report
+    report, _report = _report, None
+    if report is None or report.directory is None:
+        return None
+
+    # ru_maxrss is in KiB on Linux
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    data = {
+        "script": report.script,
+        "started": report.started,
+        "wall_time": round(time.perf_counter() - report.start_wall, 3),
+        "cpu_time": round(cpu_time() - report.start_cpu, 3),
+        "peak_rss_mib": round(usage.ru_maxrss / 1024, 1),
+        "children_peak_rss_mib": round(children.ru_maxrss / 1024, 1),
+        "stages": report.stages,
+    }
+    data.update(report.metrics)
+
+    filename = report.filename(".json")
+    with open(filename, "w") as f:
+        json.dump(data, f, indent=2)
+    return filename
+
+
+def cpu_time():
+    # Worker processes are included once they have exited
+    total = 0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def reset_peak_rss():
+    # Only possible on Linux; elsewhere the peak of the process is used
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
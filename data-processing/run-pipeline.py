@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+"""Run the steps of the pipeline whose inputs have changed.
+
+Each step has a key: a hash of its script, its input files, the settings
+it reads from stacktrends.ini and the keys of the steps it depends on. A
+step is run only if its key differs from the one recorded after its last
+successful run, or if one of its outputs is missing. For example, after
+editing selected-tags.csv only the tag list and the counts are created
+again, without importing or geocoding anything.
+"""
+
+import argparse
+import configparser
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+STATE_FILE = "data/pipeline-state.json"
+
+
+class Step:
+    def __init__(self, name, command, inputs=(), sections=(), depends=(),
+                 outputs=()):
+        self.name = name
+        self.command = command
+        self.inputs = inputs
+        self.sections = sections
+        self.depends = depends
+        self.outputs = outputs
+
+    def key(self, config, keys, hasher):
+        h = hashlib.sha256()
+        script = os.path.join(HERE, self.command[0])
+        h.update(("%s=%s\n" % (self.command[0],
+                                hasher.hash(script))).encode())
+        for filename in self.inputs:
+            h.update(("%s=%s\n" % (filename, hasher.hash(filename))).encode())
+        for section in self.sections:
+            h.update(("[%s]\n" % section).encode())
+            for option, value in sorted(config.items(section)):
+                h.update(("%s=%s\n" % (option, value)).encode())
+        for step in self.depends:
+            h.update(("%s:%s\n" % (step, keys[step])).encode())
+        return h.hexdigest()
+
+
+class FileHasher:
+    """Hash files by content, rehashing only those whose size or
+    modification time changed since the last run."""
+
+    def __init__(self, known=None):
+        self.known = known or {}
+
+    def hash(self, filename):
+        if not os.path.exists(filename):
+            return None
+
+        stat = os.stat(filename)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        known = self.known.get(filename)
+        if known is not None and known["stat"] == signature:
+            return known["sha256"]
+
+        h = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                h.update(block)
+
+        self.known[filename] = {"stat": signature, "sha256": h.hexdigest()}
+        return h.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--force", nargs="+", default=[], metavar="STEP",
+                        help="run these steps even if nothing changed")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only show which steps would run")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read("stacktrends.ini")
+    steps = pipeline_steps(config)
+
+    unknown = set(args.force) - {step.name for step in steps}
+    if unknown:
+        parser.error("unknown steps: %s" % ", ".join(sorted(unknown)))
+
+    state = read_state()
+    hasher = FileHasher(state["files"])
+    keys = {}
+
+    # Steps are listed in dependency order
+    for step in steps:
+        keys[step.name] = step.key(config, keys, hasher)
+
+        if (step.name not in args.force and
+                state["steps"].get(step.name) == keys[step.name] and
+                all(os.path.exists(output) for output in step.outputs)):
+            print("%s: up to date" % step.name)
+            continue
+
+        print("%s: running %s" % (step.name, " ".join(step.command)))
+        if args.dry_run:
+            continue
+
+        result = subprocess.run([sys.executable,
+                                 os.path.join(HERE, step.command[0])] +
+                                step.command[1:])
+        if result.returncode != 0:
+            write_state(state)
+            sys.exit("%s failed with status %d" %
+                     (step.name, result.returncode))
+
+        state["steps"][step.name] = keys[step.name]
+        write_state(state)
+
+    # Also keeps the hashes of files that were touched but not changed
+    if not args.dry_run:
+        write_state(state)
+
+
+def pipeline_steps(config):
+    database = config["Database"]["filename"]
+    selected_tags = config["Filters"]["selected_tags"]
+    gazetteer = config["GazetteerCountryCoder"].get("filename",
+                                                    "gazetteer.csv")
+    coders = [section for section in config.sections()
+              if section.endswith("CountryCoder")]
+
+    # Any of the files that 1_import-so-data.py can read the dumps from
+    raw = ["data/raw/%s%s" % (name, suffix)
+           for name in ("Users", "Posts")
+           for suffix in (".xml", ".xml.bz2", ".xml.gz", ".7z")]
+    raw += ["data/raw/stackoverflow.com-%s.7z" % name
+            for name in ("Users", "Posts")]
+
+    return [
+        Step("import", ["1_import-so-data.py"],
+             inputs=raw,
+             sections=["Database", "Import", "Intermediate"],
+             outputs=[database]),
+        Step("geocode", ["2_locations.py"],
+             inputs=[gazetteer],
+             sections=["Geocoding", "GeocodingCache"] + coders,
+             depends=["import"]),
+        Step("tags", ["3_create-datasets.py", "tags"],
+             inputs=[selected_tags],
+             sections=["Filters"],
+             outputs=["data/tags.json"]),
+        Step("countries", ["3_create-datasets.py", "countries"],
+             sections=["Database"],
+             depends=["import", "geocode"],
+             outputs=["data/countries.json"]),
+        Step("counts", ["3_create-datasets.py", "counts"],
+             inputs=[selected_tags],
+             sections=["Datasets", "Filters", "Intermediate"],
+             depends=["import", "geocode"],
+             outputs=["data/tag_year.csv", "data/country_tag.csv",
+                      "data/tag_matrix.json", "data/country_tag_year.npy"]),
+    ]
+
+
+def read_state():
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    return {"steps": {}, "files": {}}
+
+
+def write_state(state):
+    # Written after each step, so that an interrupted run keeps the
+    # steps that completed
+    with open(STATE_FILE + ".tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(STATE_FILE + ".tmp", STATE_FILE)
+
+
+if __name__ == "__main__":
+    main()
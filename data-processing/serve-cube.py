@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+"""Serve slices of the count cube written by 3_create-datasets.py.
+
+The counts of posts by country, tag and year are memory mapped, so only
+the slices that are requested are read, and the responses are cached.
+The cube is reloaded, and the cache cleared, when the file changes.
+
+    /                         countries, tags and years in the cube
+    /tags/<tag>?country=PRT   counts of a tag by year (default: worldwide)
+    /countries/<country>?year=2016&limit=10
+                              top tags of a country (default: all years)
+    /years/<year>             counts by country and tag in a year
+
+The worldwide counts are those of country "XXX".
+"""
+
+import configparser
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+from socketserver import ThreadingMixIn
+import threading
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+
+CUBE = "data/country_tag_year"
+
+
+class NotFound(LookupError):
+    pass
+
+
+class Cube:
+    def __init__(self, name):
+        with open(name + ".json") as f:
+            index = json.load(f)
+        self.counts = np.load(name + ".npy", mmap_mode="r")
+
+        self.countries = index["countries"]
+        self.tags = index["tags"]
+        self.years = index["years"]
+        self.positions = {
+            "country": {x: i for i, x in enumerate(self.countries)},
+            "tag": {x: i for i, x in enumerate(self.tags)},
+            "year": {str(x): i for i, x in enumerate(self.years)},
+        }
+
+    def position(self, kind, value):
+        try:
+            return self.positions[kind][value]
+        except KeyError:
+            raise NotFound("Unknown %s: %s" % (kind, value))
+
+    def index(self):
+        return {"countries": self.countries, "tags": self.tags,
+                "years": self.years}
+
+    def tag_years(self, tag, country="XXX"):
+        counts = self.counts[self.position("country", country)]
+        totals = counts.sum(axis=0)
+        counts = counts[self.position("tag", tag)]
+
+        return {"tag": tag, "country": country, "years": self.years,
+                "count": counts.tolist(),
+                "freq": frequencies(counts, totals)}
+
+    def country_tags(self, country, year=None, limit=None):
+        counts = self.counts[self.position("country", country)]
+        if year is None:
+            counts = counts.sum(axis=1)
+        else:
+            counts = counts[:, self.position("year", year)]
+
+        # Most frequent tags first, leaving out those never used
+        order = np.argsort(-counts, kind="stable")
+        order = order[counts[order] > 0][:limit]
+
+        return {"country": country,
+                "year": None if year is None else int(year),
+                "tags": [self.tags[i] for i in order],
+                "count": counts[order].tolist(),
+                "freq": frequencies(counts[order], counts.sum())}
+
+    def year_counts(self, year):
+        counts = self.counts[:, :, self.position("year", year)]
+        return {"year": int(year), "countries": self.countries,
+                "tags": self.tags, "count": counts.tolist()}
+
+
+def frequencies(counts, totals):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        freq = counts / totals
+    return np.where(np.isfinite(freq), freq, 0).tolist()
+
+
+class CubeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, name, cache_size):
+        super().__init__(address, CubeHandler)
+        self.name = name
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.cube = None
+        self.response = lru_cache(cache_size)(self.render)
+
+    def current_cube(self):
+        # A stat per request is much cheaper than serving stale counts
+        mtime = os.stat(self.name + ".npy").st_mtime_ns
+        with self.lock:
+            if mtime != self.mtime:
+                self.cube = Cube(self.name)
+                self.mtime = mtime
+                self.response.cache_clear()
+            return self.cube
+
+    def render(self, path, cube):
+        """Return the status and body of the response to a path.
+
+        The cube is part of the cache key, so that responses computed
+        from a replaced cube are never reused.
+        """
+        url = urlparse(path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+
+        try:
+            if parts == [""]:
+                body = cube.index()
+            elif len(parts) == 2 and parts[0] == "tags":
+                body = cube.tag_years(parts[1], query.get("country", "XXX"))
+            elif len(parts) == 2 and parts[0] == "countries":
+                limit = query.get("limit")
+                body = cube.country_tags(
+                    parts[1], query.get("year"),
+                    None if limit is None else int(limit))
+            elif len(parts) == 2 and parts[0] == "years":
+                body = cube.year_counts(parts[1])
+            else:
+                raise NotFound("Not found: %s" % url.path)
+        except NotFound as e:
+            return 404, json.dumps({"error": str(e)}).encode()
+        except ValueError as e:
+            return 400, json.dumps({"error": str(e)}).encode()
+
+        return 200, json.dumps(body, separators=(",", ":")).encode()
+
+
+class CubeHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        status, body = self.server.response(self.path,
+                                            self.server.current_cube())
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        # The web app is served from a different origin during development
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    config = configparser.ConfigParser()
+    config.read("stacktrends.ini")
+    server_config = config["CubeServer"]
+
+    address = (server_config.get("host", "127.0.0.1"),
+               int(server_config.get("port", 8001)))
+    server = CubeServer(address, CUBE,
+                        int(server_config.get("cache_size", 1024)))
+    server.current_cube()
+
+    print("Serving %s.npy on http://%s:%d/" % ((CUBE,) + address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
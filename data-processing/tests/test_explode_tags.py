@@ -0,0 +1,125 @@
+"""Regression test of explode_tags against its original implementation."""
+
+import importlib.util
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+try:
+    from pandas.testing import assert_frame_equal
+except ImportError:
+    # pandas < 0.20
+    from pandas.util.testing import assert_frame_equal
+
+DATA_PROCESSING = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DATA_PROCESSING)
+
+spec = importlib.util.spec_from_file_location(
+    "create_datasets", os.path.join(DATA_PROCESSING, "3_create-datasets.py"))
+create_datasets = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(create_datasets)
+
+
+def original_explode_tags(posts, selected_tags):
+    """explode_tags and rename_tags as they were before being vectorized."""
+    posts = posts.copy()
+
+    posts["Tags"] = posts["Tags"].str[1:-1].str.split("><")
+
+    answers_tags = posts[posts.PostTypeId == 2][["ParentId"]]
+    answers_tags = answers_tags.join(posts[["Tags"]], on="ParentId")
+    posts.update(answers_tags[["Tags"]])
+
+    posts = posts[["year", "Tags", "OwnerUserId", "country"]]
+    posts = posts.rename(columns={"OwnerUserId": "user"})
+
+    posts = posts[~pd.isnull(posts["Tags"])]
+    new_index = np.hstack([[post_id] * len(tag) for post_id, tag
+                           in posts["Tags"].items()])
+    posts_tags = pd.DataFrame({"tag": np.hstack(posts["Tags"])}, new_index)
+    posts = posts_tags.join(posts[["year", "user", "country"]])
+
+    posts = posts.merge(selected_tags, "left", left_on="tag",
+                        right_index=True)
+    posts = posts.drop("tag", axis=1)
+    posts = posts.rename(columns={"newname": "tag"})
+    posts["tag"] = posts["tag"].where(pd.notnull(posts["tag"]), "Other")
+
+    return posts
+
+
+def synthetic_posts(size=2000, seed=0):
+    """Return posts as read by create_datasets, in a shuffled id order.
+
+    Some questions have no tags, and some answers have no parent, a
+    parent that is not in the dump, an untagged parent or tags of their
+    own.
+    """
+    random = np.random.RandomState(seed)
+    vocabulary = ["python", "java", "c#", "javascript", "haskell",
+                  "cobol", "fortran", "r"]
+
+    ids = random.permutation(np.arange(1, size + 1))
+    post_types = random.choice([1, 2], size, p=[0.4, 0.6])
+    questions = ids[post_types == 1]
+
+    tags = []
+    for post_type in post_types:
+        if post_type == 1 and random.rand() < 0.9 or random.rand() < 0.05:
+            chosen = random.choice(vocabulary, random.randint(1, 6),
+                                   replace=False)
+            tags.append("".join("<%s>" % tag for tag in chosen))
+        else:
+            tags.append(None)
+
+    parents = np.where(post_types == 2, random.choice(questions, size),
+                       create_datasets.NO_ID)
+    orphans = (post_types == 2) & (random.rand(size) < 0.1)
+    parents[orphans] = random.choice([create_datasets.NO_ID, size + 1000],
+                                     orphans.sum())
+
+    countries = pd.Categorical(
+        random.choice(["PRT", "USA", "IND", None], size))
+
+    posts = pd.DataFrame({
+        "PostTypeId": post_types,
+        "ParentId": parents,
+        "OwnerUserId": random.randint(1, 50, size),
+        "Tags": tags,
+        "year": random.randint(2008, 2017, size),
+    }, pd.Index(ids, name="Id"))
+    posts = create_datasets.compact_posts(posts)
+    posts["country"] = countries
+
+    return posts
+
+
+class ExplodeTagsTest(unittest.TestCase):
+    def setUp(self):
+        self.selected_tags = pd.DataFrame(
+            {"newname": ["Python", "Java", "C#", "JavaScript"]},
+            pd.Index(["python", "java", "c#", "javascript"], name="tag"))
+
+    def test_same_as_original(self):
+        posts = synthetic_posts()
+
+        exploded = create_datasets.explode_tags(posts, self.selected_tags)
+        expected = original_explode_tags(posts, self.selected_tags)
+
+        self.assertEqual(
+            list(exploded["tag"].cat.categories),
+            ["C#", "Java", "JavaScript", "Other", "Python"])
+        # Some versions of pandas sort the rows of the original by id in
+        # the join, so the rows are compared in id order
+        exploded["tag"] = exploded["tag"].astype(object)
+        assert_frame_equal(
+            exploded[expected.columns].sort_index(kind="mergesort"),
+            expected.sort_index(kind="mergesort"),
+            check_index_type=False, check_dtype=False)
+
+
+if __name__ == "__main__":
+    unittest.main()
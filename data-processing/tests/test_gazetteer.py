@@ -0,0 +1,48 @@
+"""Tests of the offline gazetteer country coder."""
+
+import configparser
+import importlib.util
+import os
+import sys
+import unittest
+
+DATA_PROCESSING = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DATA_PROCESSING)
+
+spec = importlib.util.spec_from_file_location(
+    "locations", os.path.join(DATA_PROCESSING, "2_locations.py"))
+locations = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(locations)
+
+
+class GazetteerCountryCoderTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        config = configparser.ConfigParser()
+        config.read_dict({"GazetteerCountryCoder": {
+            "filename": os.path.join(DATA_PROCESSING, "gazetteer.csv")}})
+        cls.coder = locations.GazetteerCountryCoder(config)
+
+    def test_known_places(self):
+        for location, country in [("Berlin", "DEU"),
+                                  ("London, UK", "GBR"),
+                                  ("Lisbon, Portugal", "PRT"),
+                                  ("Bangalore, India", "IND"),
+                                  ("Toronto, Ontario, Canada", "CAN")]:
+            with self.subTest(location=location):
+                self.assertEqual(self.coder.getCountry(location), country)
+
+    def test_unknown_places_containing_known_names(self):
+        # Each of these contains the name of a country, but the rest of
+        # the name is not known, so the location is not resolved
+        for location in ["New England", "Jersey City, NJ",
+                         "Panama City, FL", "Lebanon, NH", "Peru, IL"]:
+            with self.subTest(location=location):
+                self.assertIsNone(self.coder.getCountry(location))
+
+    def test_places_that_disagree(self):
+        self.assertIsNone(self.coder.getCountry("Paris, Germany"))
+
+
+if __name__ == "__main__":
+    unittest.main()